@@ -1,11 +1,198 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.db import transaction
+from django.db.models import Count, Q
 from monitor.models import (GangliaGraph, CrashEvent, User, Host, Command,
-                            Queue)
-
-# Register your models here.
-admin.site.register(CrashEvent)
-admin.site.register(GangliaGraph)
-admin.site.register(User)
-admin.site.register(Host)
-admin.site.register(Command)
-admin.site.register(Queue)
+                            Queue, Blob, updateSignature)
+
+# The tables grow with every crash so none of the admin pages below should
+# do a query per row, a query that joins or aggregates every row, or render a
+# select with every crash / user in it:
+#     - counts of related objects are looked up for the page shown only
+#       (CountsAdmin) rather than annotated onto the queryset, which made
+#       paging and the date hierarchy group the joins of every crash
+#     - foreign keys are followed with list_select_related
+#     - relations use autocomplete_fields (or raw_id_fields, a text box of
+#       ids, for crashes) instead of selects
+#     - searches are case sensitive prefix searches (IndexedSearchAdmin).
+#       Django's '^' is istartswith, UPPER(column) LIKE, which can't use the
+#       index. startswith can on postgres (django adds a pattern index for
+#       unique and indexed text columns) but not on sqlite, where LIKE has no
+#       index.
+#     - show_full_result_count is off so filtering doesn't count everything
+
+
+class IndexedSearchAdmin(admin.ModelAdmin):
+    '''A base admin that searches the '^' search_fields with a case sensitive
+    startswith (which can use an index) instead of istartswith'''
+
+    def get_search_results(self, request, queryset, search_term):
+        fields = self.get_search_fields(request)
+        if not search_term or not all(f.startswith("^") for f in fields):
+            return super().get_search_results(request, queryset, search_term)
+        # like django, every word has to match one of the fields
+        for term in search_term.split():
+            query = Q()
+            for field in fields:
+                query |= Q(**{field[1:] + "__startswith": term})
+            queryset = queryset.filter(query)
+        # the fields are on the model or a foreign key, no duplicate rows
+        return queryset, False
+
+
+class CountsChangeList(ChangeList):
+    'A change list that adds the counts of a CountsAdmin to the page shown'
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.result_list = list(self.result_list)
+        self.model_admin.addCounts(self.result_list)
+
+
+class CountsAdmin(IndexedSearchAdmin):
+    '''A base admin that shows the number of related objects. counts maps
+    the name of the count to the model (usually a many to many through table)
+    and the name of its field that points at this model.'''
+    counts = {}
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return CountsChangeList
+
+    def addCounts(self, objects):
+        '''Sets the counts as attributes of the objects, one grouped query
+        per count over the ids of the objects'''
+        ids = [obj.pk for obj in objects]
+        for name, (model, field) in self.counts.items():
+            found = dict(model.objects.filter(**{field + "__in": ids})
+                         .order_by().values_list(field)
+                         .annotate(Count("pk")))
+            for obj in objects:
+                setattr(obj, name, found.get(obj.pk, 0))
+
+
+def countColumn(name, description):
+    'Returns a column for list_display that shows a count of CountsAdmin'
+    def column(self, obj):
+        return getattr(obj, name, None)
+    column.short_description = description
+    return column
+
+
+class CrashEventAdmin(CountsAdmin):
+    counts = {"numUsers": (User.crashes.through, "crashevent"),
+              "numQueues": (Queue.crashes.through, "crashevent"),
+              "numCommands": (Command.crashes.through, "crashevent")}
+    list_display = ("id", "hostAddress", "date", "numUsers", "numQueues",
+                    "numCommands")
+    list_select_related = ("host",)
+    date_hierarchy = "date"
+    ordering = ("-date",)
+    search_fields = ("^host__address",)
+    autocomplete_fields = ("host",)
+    actions = ["deleteGangliaGraphs"]
+
+    numUsers = countColumn("numUsers", "Users")
+    numQueues = countColumn("numQueues", "Queues")
+    numCommands = countColumn("numCommands", "Commands")
+
+    def hostAddress(self, obj):
+        return obj.host.address
+    hostAddress.short_description = "Host"
+    hostAddress.admin_order_field = "host__address"
+
+    def deleteGangliaGraphs(self, request, queryset):
+        'Frees the space used by the graphs but keeps the crash and lsf data'
+        # delete through the queryset so the files are released one by one
+        numDeleted = GangliaGraph.objects.filter(
+            crashEvent__in=queryset).delete()[0]
+        self.message_user(request, "Deleted {} graphs".format(numDeleted))
+    deleteGangliaGraphs.short_description = ("Delete ganglia graphs of "
+                                             "selected crashes")
+
+
+class HostAdmin(CountsAdmin):
+    counts = {"numCrashes": (CrashEvent, "host")}
+    list_display = ("address", "numCrashes")
+    search_fields = ("^address",)
+
+    numCrashes = countColumn("numCrashes", "Crashes")
+
+
+class UserAdmin(CountsAdmin):
+    counts = {"numCrashes": (User.crashes.through, "user"),
+              "numCommands": (Command.users.through, "user")}
+    list_display = ("name", "numCrashes", "numCommands")
+    search_fields = ("^name",)
+    raw_id_fields = ("crashes",)
+
+    numCrashes = countColumn("numCrashes", "Crashes")
+    numCommands = countColumn("numCommands", "Commands")
+
+
+class QueueAdmin(CountsAdmin):
+    counts = {"numCrashes": (Queue.crashes.through, "queue")}
+    list_display = ("name", "numCrashes")
+    search_fields = ("^name",)
+    raw_id_fields = ("crashes",)
+
+    numCrashes = countColumn("numCrashes", "Crashes")
+
+
+class CommandAdmin(CountsAdmin):
+    counts = {"numCrashes": (Command.crashes.through, "command"),
+              "numUsers": (Command.users.through, "command")}
+    list_display = ("id", "shortText", "numCrashes", "numUsers")
+    # the command text can match anywhere so this can't use the index
+    search_fields = ("text",)
+    raw_id_fields = ("crashes",)
+    autocomplete_fields = ("users",)
+    readonly_fields = ("distribution",)
+    actions = ["mergeCommands"]
+
+    numCrashes = countColumn("numCrashes", "Crashes")
+    numUsers = countColumn("numUsers", "Users")
+
+    def mergeCommands(self, request, queryset):
+        '''Merges the selected commands into the oldest one, for commands
+        that addToSavedCommands didn't recognise as similar'''
+        commands = list(queryset.order_by("pk"))
+        if len(commands) < 2:
+            self.message_user(request, "Select at least two commands")
+            return
+        keep, others = commands[0], commands[1:]
+        with transaction.atomic():
+            crashes = list(CrashEvent.objects.filter(command__in=others)
+                           .distinct())
+            keep.crashes.add(*crashes)
+            keep.users.add(*User.objects.filter(command__in=others))
+            Command.objects.filter(pk__in=[c.pk for c in others]).delete()
+            # the signatures of the crashes have the merged commands in them
+            for crash in crashes:
+                updateSignature(crash)
+        self.message_user(request, "Merged {} commands into {}".format(
+            len(others), keep.pk))
+    mergeCommands.short_description = "Merge selected commands"
+
+
+class GangliaGraphAdmin(admin.ModelAdmin):
+    list_display = ("id", "crashEvent", "plotType", "timePeriod")
+    list_select_related = ("crashEvent__host",)
+    list_filter = ("plotType", "timePeriod")
+    raw_id_fields = ("crashEvent",)
+    show_full_result_count = False
+
+
+class BlobAdmin(IndexedSearchAdmin):
+    list_display = ("key", "size", "storedSize", "references")
+    search_fields = ("^key",)
+    show_full_result_count = False
+
+
+admin.site.register(CrashEvent, CrashEventAdmin)
+admin.site.register(GangliaGraph, GangliaGraphAdmin)
+admin.site.register(User, UserAdmin)
+admin.site.register(Host, HostAdmin)
+admin.site.register(Command, CommandAdmin)
+admin.site.register(Queue, QueueAdmin)
+admin.site.register(Blob, BlobAdmin)
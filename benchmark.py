@@ -0,0 +1,530 @@
+# -------------------------------- DOC STRING ---------------------------------
+
+'''A benchmark harness for the crash ingestion and the pages that display it.
+
+Nothing here talks to the real lsf or ganglia. Instead:
+    - synthetic 'bjobs' fixed width output is generated (the same layout that
+      mon.queryLsf asks bjobs for) and handed to mon.py in place of calling
+      the bjobsLSF.sh wrapper
+    - a local fake ganglia http server is started which answers every graph
+      request with a fixed size image
+    - the Command table is pre-populated with a configurable number of
+      commands (and crashes for the pages to display)
+
+Each stage is timed several times and the results are returned as a
+dictionary which is written out as json by the 'benchmarkIngestion'
+management command so that runs of different versions can be compared.
+
+runStressTest registers crashes from several processes at once, all sharing
+the same new users, queues and commands so that they race to create them,
+and checks that every crash was saved exactly once and completely, and that
+registrations of the same host at once are coalesced into one crash (used by
+the 'stressIngestion' management command).
+
+This should only ever be run against a throw away database and media root,
+the management commands set both of these up.
+'''
+
+# ------------------------------- DEPENDENCIES -------------------------------
+# STANDARD IMPORTS (should come included with python3)
+import csv
+import random
+import time
+import statistics
+import platform
+import threading
+import multiprocessing
+from contextlib import redirect_stdout  # to hide the prints from mon.py
+from io import StringIO
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import mock  # to swap bjobs and ganglia for the local fakes
+
+# PIP IMPORTS (need to be installed with pip3)
+# django
+import django
+from django.utils import timezone
+from django.core.files.base import File
+from django.test import RequestFactory
+from django.db import connections
+
+# LOCAL IMPORTS (other files)
+from monitor import mon, views, commandAnalyse
+from monitor.models import (CrashEvent, Host, User, Queue, Command,
+                            addToSavedCommands, updateSignature)
+from monitor.conf import (LSF_FIELDS, LSF_FIELDS_INDEX_USER,
+                          LSF_FIELDS_INDEX_QUEUE, LSF_FIELDS_INDEX_COMMAND,
+                          GANGLIA_TIMES, GANGLIA_REPORTS, GANGLIA_BASIC)
+
+
+# ------------------------------- SETTINGS ------------------------------------
+
+# the default size of each part of the benchmark, these can all be changed
+# from the command line of the management command
+DEFAULTS = {
+    "jobs": 20,  # number of jobs (rows) in each synthetic bjobs output
+    "cellWidth": 4096,  # the width mon.queryLsf asks bjobs for
+    "commands": 200,  # number of Commands to pre-populate
+    "crashes": 100,  # number of CrashEvents to pre-populate for the pages
+    "users": 30,  # size of the pool of synthetic users
+    "queues": 6,  # size of the pool of synthetic queues
+    "imageBytes": 20000,  # size of each fake ganglia image
+    "repeats": 5,  # number of times each stage is timed
+    "seed": 0,  # seed for the random generator so runs are repeatable
+}
+
+# words used to build synthetic commands, a mix of the boilerplate that
+# appears in most job scripts and more specific words
+COMMAND_WORDS = ["module", "load", "python", "jaspy", "cd", "export", "srun",
+                 "mpirun", "-np", "$HOME", "${LSB_JOBID}", "run_model",
+                 "analysis", "regrid", "cdo", "ncks", "-O", "--input",
+                 "--output", "data", "tmp", "work", "scratch", "netcdf",
+                 "idl", "matlab", "-nodisplay", "R", "CMD", "BATCH", "echo",
+                 "done", "for", "in", "do", "ls", "cp", "mv", "rm", "-rf"]
+
+# a tiny but valid png header, the rest of the image is padded to size
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+
+
+# ------------------------- SYNTHETIC LSF OUTPUT -----------------------------
+
+
+def makeCommandText(rand, uniqueWord=None):
+    '''Makes a plausible looking lsf command (lines joined with ; as lsf
+    does). If uniqueWord is given it is added so the command is distinct.'''
+    lines = []
+    for _ in range(rand.randint(1, 6)):
+        lines.append(" ".join(rand.choice(COMMAND_WORDS)
+                              for _ in range(rand.randint(2, 8))))
+    if uniqueWord is not None:
+        lines.append("run_{}".format(uniqueWord))
+    return ";".join(lines)
+
+
+def makeJobRow(rand, users, queues, jobId, host, commands=None):
+    '''Makes a list of cells for one job in the order of LSF_FIELDS. The
+    command is chosen from commands if given, otherwise it is new.'''
+    cells = []
+    for field in LSF_FIELDS:
+        if field == "jobid":
+            cells.append(str(jobId))
+        elif field == "stat":
+            cells.append("RUN")
+        elif field in ("exec_host", "first_host"):
+            cells.append(host)
+        else:
+            cells.append("-")
+    cells[LSF_FIELDS_INDEX_USER] = rand.choice(users)
+    cells[LSF_FIELDS_INDEX_QUEUE] = rand.choice(queues)
+    if commands is not None:
+        cells[LSF_FIELDS_INDEX_COMMAND] = rand.choice(commands)
+    else:
+        cells[LSF_FIELDS_INDEX_COMMAND] = makeCommandText(rand)
+    return cells
+
+
+def makeBjobsOutput(rand, numJobs, host, users, queues, cellWidth,
+                    delimiter="|", commands=None):
+    '''Returns bytes as bjobs would print them for the fixed width format
+    requested in mon.queryLsf. Every cell is padded (or truncated like bjobs
+    does) to cellWidth and cells are separated by the delimiter.'''
+    def formatRow(cells):
+        return delimiter.join(cell[:cellWidth].ljust(cellWidth)
+                              for cell in cells)
+    lines = [formatRow([field.upper() for field in LSF_FIELDS])]
+    for jobId in range(numJobs):
+        lines.append(formatRow(makeJobRow(rand, users, queues,
+                                          1000000 + jobId, host, commands)))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+# --------------------------- FAKE GANGLIA SERVER -----------------------------
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    'A http server which handles each request in a new thread'
+    daemon_threads = True
+
+
+class FakeGanglia:
+    '''A local http server that answers every request with the same image.
+    Use as a context manager, 'root' is then a drop in for GANGLIA_ROOT'''
+
+    def __init__(self, imageBytes):
+        image = PNG_HEADER + b"\0" * max(0, imageBytes - len(PNG_HEADER))
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(image)))
+                self.end_headers()
+                self.wfile.write(image)
+
+            def log_message(self, *args):
+                # don't print every request
+                pass
+
+        # port 0 lets the operating system choose a free port
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.root = "http://127.0.0.1:{}/graph.php?".format(
+            self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ------------------------------ POPULATING ----------------------------------
+
+
+def populateCommands(rand, numCommands, users):
+    '''Creates numCommands distinct commands linked to random users. They are
+    created in bulk because addToSavedCommands is what is being measured.'''
+    commands = []
+    for i in range(numCommands):
+        text = makeCommandText(rand, uniqueWord=i)
+        command = Command(text=text)
+        command.setDistribution(commandAnalyse.analyseCommand(text))
+        commands.append(command)
+    Command.objects.bulk_create(commands)
+    # bulk_create doesn't always set the primary keys so fetch them again
+    commands = list(Command.objects.all())
+    Through = Command.users.through
+    Through.objects.bulk_create([Through(command_id=command.pk,
+                                         user_id=rand.choice(users).pk)
+                                 for command in commands])
+    return commands
+
+
+def populateCrashes(rand, numCrashes, hosts, users, queues, commands,
+                    numJobs, cellWidth):
+    '''Creates numCrashes crash events each with an lsf csv file and links to
+    random users, queues and commands so the pages have data to show.'''
+    userNames = [user.name for user in users]
+    queueNames = [queue.name for queue in queues]
+    for _ in range(numCrashes):
+        host = rand.choice(hosts)
+        crash = CrashEvent(date=timezone.now(), host=host)
+        crash.save()
+        output = makeBjobsOutput(rand, numJobs, host.address, userNames,
+                                 queueNames, cellWidth)
+        data, headers = mon.parseBjobsOutput(output.decode("utf-8"))
+        out = StringIO()
+        lsfWriter = csv.writer(out)
+        lsfWriter.writerow(headers)
+        lsfWriter.writerows(data)
+        crash.lsfData.save("placeholder", File(out))
+        crash.user_set.add(*rand.sample(users, min(3, len(users))))
+        crash.queue_set.add(rand.choice(queues))
+        if commands:
+            crash.command_set.add(*rand.sample(commands,
+                                               min(3, len(commands))))
+        updateSignature(crash)
+
+
+# -------------------------------- TIMING -------------------------------------
+
+
+def timeRepeated(function, repeats, setup=None):
+    '''Calls function repeats times and returns a summary of the timings in
+    seconds. setup is called (untimed) before each run and its return value
+    is passed to function. Anything printed is hidden.'''
+    timings = []
+    for _ in range(repeats):
+        with redirect_stdout(StringIO()):
+            argument = setup() if setup is not None else None
+            start = time.perf_counter()
+            if setup is not None:
+                function(argument)
+            else:
+                function()
+            timings.append(time.perf_counter() - start)
+    return {
+        "runs": timings,
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "max": max(timings),
+    }
+
+
+def runBenchmarks(label="", **options):
+    '''Runs every benchmark and returns the results as a dictionary that can
+    be dumped to json. options override the values in DEFAULTS.'''
+    params = dict(DEFAULTS)
+    params.update((k, v) for k, v in options.items() if v is not None)
+    rand = random.Random(params["seed"])
+    repeats = params["repeats"]
+
+    # the pools of objects that everything is built from
+    hosts = [Host.objects.create(address="host{:03d}.jc.rl.ac.uk".format(i))
+             for i in range(10)]
+    users = [User.objects.create(name="user{}".format(i))
+             for i in range(params["users"])]
+    queues = [Queue.objects.create(name="queue-{}".format(i))
+              for i in range(params["queues"])]
+    userNames = [user.name for user in users]
+    queueNames = [queue.name for queue in queues]
+    commands = populateCommands(rand, params["commands"], users)
+
+    def newBjobsOutput():
+        return makeBjobsOutput(rand, params["jobs"], hosts[0].address,
+                               userNames, queueNames, params["cellWidth"])
+
+    def newCrash():
+        crash = CrashEvent(date=timezone.now(), host=hosts[0])
+        crash.save()
+        return crash
+
+    results = {}
+
+    # parsing the fixed width bjobs output on its own
+    bjobsOutput = newBjobsOutput().decode("utf-8")
+    results["parseBjobsOutput"] = timeRepeated(
+        lambda: mon.parseBjobsOutput(bjobsOutput), repeats)
+
+    # matching a single command against the pre-populated Command table
+    def setupAddToSavedCommands():
+        return (makeCommandText(rand), rand.choice(users), newCrash())
+    results["addToSavedCommands"] = timeRepeated(
+        lambda args: addToSavedCommands(*args), repeats,
+        setup=setupAddToSavedCommands)
+
+    # saving the csv and linking the users, queues and commands of a crash
+    def setupSetupLsfData():
+        data, headers = mon.parseBjobsOutput(
+            newBjobsOutput().decode("utf-8"))
+        return newCrash(), data, headers
+    results["setupLsfData"] = timeRepeated(
+        lambda args: args[0].setupLsfData(args[1], args[2]), repeats,
+        setup=setupSetupLsfData)
+
+    # the whole registration of a crash against the fakes, each on a new host
+    # so that it isn't coalesced with the one before
+    newHosts = ("host{:03d}.jc.rl.ac.uk".format(i) for i in range(100, 1000))
+    registered = []  # the ids of the crashes, they have graphs to show
+    with FakeGanglia(params["imageBytes"]) as ganglia:
+        def setupRunThroughCrash():
+            return next(newHosts), newBjobsOutput()
+        def runThroughCrash(args):
+            with mock.patch.object(mon, "check_output",
+                                   return_value=args[1]), \
+                    mock.patch.object(mon, "GANGLIA_ROOT", ganglia.root):
+                registered.append(mon.runThroughCrash(args[0]).pk)
+        results["runThroughCrash"] = timeRepeated(
+            runThroughCrash, repeats, setup=setupRunThroughCrash)
+
+    # the pages, with crashes to display
+    populateCrashes(rand, params["crashes"], hosts, users, queues, commands,
+                    params["jobs"], params["cellWidth"])
+    factory = RequestFactory()
+    results["views.index"] = timeRepeated(
+        lambda: views.index(factory.get("/")), repeats)
+    # a fully registered crash (populateCrashes makes no graphs, so their
+    # page is the short 'not available' one)
+    crashId = registered[-1]
+
+    def detailOfCrash():
+        return views.detailOfCrash(
+            factory.get("/saved-crash/{}".format(crashId)), i=crashId)
+    results["views.detailOfCrash"] = timeRepeated(detailOfCrash, repeats)
+    page = detailOfCrash().content.decode("utf-8")
+    # check the lsf table and the graphs were actually rendered
+    assert "<table" in page and 'class="graph"' in page
+    results["views.detailOfCrash"]["bytes"] = len(page)
+    crash = CrashEvent.objects.get(pk=crashId)
+    results["getSimilarCrashes"] = timeRepeated(
+        lambda: crash.getSimilarCrashes(5), repeats)
+
+    return {
+        "label": label,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "parameters": params,
+        "tableSizes": {
+            "CrashEvent": CrashEvent.objects.count(),
+            "Command": Command.objects.count(),
+            "User": User.objects.count(),
+            "Queue": Queue.objects.count(),
+        },
+        "results": results,
+    }
+
+
+# ---------------------------- STRESS TESTING ---------------------------------
+
+
+def stressWorker(args, barrier, results):
+    '''Registers crashes one after another in its own process (see
+    runStressTest). Puts a list of what each registration should have saved,
+    or the error if it failed, on the results queue.'''
+    (workerId, hosts, numJobs, userNames, queueNames, commands, gangliaRoot,
+     seed) = args
+    rand = random.Random(seed * 1000 + workerId)
+    registrations = []
+    # start every worker at the same moment so they race
+    barrier.wait()
+    for host in hosts:
+        output = makeBjobsOutput(rand, numJobs, host, userNames, queueNames,
+                                 256, commands=commands)
+        data = mon.parseBjobsOutput(output.decode("utf-8"))[0]
+        registration = {
+            "host": host,
+            "users": sorted(set(row[LSF_FIELDS_INDEX_USER] for row in data)),
+            "queues": sorted(set(row[LSF_FIELDS_INDEX_QUEUE]
+                                 for row in data)),
+        }
+        try:
+            with redirect_stdout(StringIO()), \
+                    mock.patch.object(mon, "check_output",
+                                      return_value=output), \
+                    mock.patch.object(mon, "GANGLIA_ROOT", gangliaRoot):
+                registration["crash"] = mon.runThroughCrash(host).pk
+        except Exception as e:
+            registration["error"] = "{}: {}".format(type(e).__name__, e)
+        registrations.append(registration)
+    connections.close_all()
+    results.put(registrations)
+
+
+def checkRegistration(registration, numJobs):
+    'Returns a list of problems with the crash saved by a registration'
+    problems = []
+    try:
+        crash = CrashEvent.objects.get(pk=registration["crash"])
+    except CrashEvent.DoesNotExist:
+        return ["crash {} is missing".format(registration["crash"])]
+    name = "crash {}".format(crash.pk)
+    if crash.host.address != registration["host"]:
+        problems.append("{} has the wrong host".format(name))
+    users = sorted(crash.user_set.values_list("name", flat=True))
+    if users != registration["users"]:
+        problems.append("{} has users {} not {}".format(
+            name, users, registration["users"]))
+    queues = sorted(crash.queue_set.values_list("name", flat=True))
+    if queues != registration["queues"]:
+        problems.append("{} has queues {} not {}".format(
+            name, queues, registration["queues"]))
+    if not crash.command_set.exists():
+        problems.append("{} has no commands".format(name))
+    rows = crash.getLsfRows()
+    if rows is None or len(rows) != numJobs + 1:
+        problems.append("{} has incomplete lsf data".format(name))
+    numGraphs = len(GANGLIA_TIMES) * (len(GANGLIA_REPORTS) +
+                                      len(GANGLIA_BASIC))
+    if crash.gangliagraph_set.count() != numGraphs:
+        problems.append("{} has {} graphs not {}".format(
+            name, crash.gangliagraph_set.count(), numGraphs))
+    return problems
+
+
+def runWorkers(hostsPerWorker, numJobs, userNames, queueNames, commands,
+               seed):
+    '''Starts a process for each list of hosts in hostsPerWorker that
+    registers a crash on each of them (see stressWorker). Returns the list of
+    registrations from all of them and the time it took.'''
+    with FakeGanglia(1000) as ganglia:
+        args = [(workerId, hosts, numJobs, userNames, queueNames, commands,
+                 ganglia.root, seed)
+                for workerId, hosts in enumerate(hostsPerWorker)]
+        # the children must open their own database connections
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        barrier = context.Barrier(len(args))
+        results = context.Queue()
+        processes = [context.Process(target=stressWorker,
+                                     args=(workerArgs, barrier, results))
+                     for workerArgs in args]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        # read the results before joining so a full queue can't block
+        registrations = [r for _ in processes for r in results.get()]
+        for process in processes:
+            process.join()
+        return registrations, time.perf_counter() - start
+
+
+def runStressTest(workers=8, crashesPerWorker=5, jobs=10, commands=10,
+                  users=20, queues=3, seed=0):
+    '''Registers crashesPerWorker crashes (each on a different host) from
+    each of workers processes at once and checks that none were lost,
+    duplicated or only half saved. Then registers a crash on the same host
+    from every process at once and checks that they were coalesced into one.
+    Returns a dictionary of the results with 'ok' and a list of 'problems'.
+
+    The database must be one that other processes can connect to (ie not an
+    in memory sqlite database).'''
+    # host999 is kept for the coalescing test
+    expected = workers * crashesPerWorker
+    assert expected < 999
+    rand = random.Random(seed)
+    # none of these exist yet so the workers race to create them
+    userNames = ["stressuser{}".format(i) for i in range(users)]
+    queueNames = ["stress-queue-{}".format(i) for i in range(queues)]
+    commandTexts = [makeCommandText(rand, uniqueWord=i)
+                    for i in range(commands)]
+
+    hostsPerWorker = [["host{:03d}.jc.rl.ac.uk".format(
+        workerId * crashesPerWorker + i) for i in range(crashesPerWorker)]
+        for workerId in range(workers)]
+    registrations, seconds = runWorkers(hostsPerWorker, jobs, userNames,
+                                        queueNames, commandTexts, seed)
+    problems = ["registration on {} failed: {}".format(r["host"], r["error"])
+                for r in registrations if "error" in r]
+    crashIds = [r["crash"] for r in registrations if "crash" in r]
+    if len(set(crashIds)) != len(crashIds):
+        problems.append("the same crash id was returned more than once")
+    saved = CrashEvent.objects.count()
+    if saved != expected:
+        problems.append("{} crashes were saved, not {}".format(saved,
+                                                              expected))
+    for registration in registrations:
+        if "crash" in registration:
+            problems.extend(checkRegistration(registration, jobs))
+    for model, names in ((User, userNames), (Queue, queueNames)):
+        # the name is unique so there can't be duplicates, check none are lost
+        found = model.objects.filter(name__in=names).count()
+        used = set(n for r in registrations
+                   for n in r[model.__name__.lower() + "s"])
+        if found != len(used):
+            problems.append("{} {}s saved, {} used".format(
+                found, model.__name__, len(used)))
+
+    # every worker registers the same host at once
+    host = "host999.jc.rl.ac.uk"
+    coalesced, coalescedSeconds = runWorkers([[host]] * workers, jobs,
+                                             userNames, queueNames,
+                                             commandTexts, seed + 1)
+    problems.extend("registration on {} failed: {}".format(r["host"],
+                                                           r["error"])
+                    for r in coalesced if "error" in r)
+    if len(set(r.get("crash") for r in coalesced)) != 1:
+        problems.append("registrations on the same host weren't coalesced")
+    numOnHost = CrashEvent.objects.filter(host__address=host).count()
+    if numOnHost != 1:
+        problems.append("{} crashes were saved for {}, not 1".format(
+            numOnHost, host))
+    # only one of the registrations actually saved its data
+    elif all(checkRegistration(r, jobs) for r in coalesced if "crash" in r):
+        problems.append("the coalesced crash doesn't match any registration")
+
+    return {
+        "workers": workers,
+        "crashesPerWorker": crashesPerWorker,
+        "expected": expected,
+        "saved": saved,
+        "commands": Command.objects.count(),
+        "seconds": seconds,
+        "crashesPerSecond": expected / seconds,
+        "coalescedSeconds": coalescedSeconds,
+        "problems": problems,
+        "ok": not problems,
+    }
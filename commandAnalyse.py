@@ -1,10 +1,18 @@
 '''A python script to analyse the commands submitted to lsf, they need to be
 analysed so that they can be grouped according to similaries based on the
 distribution of words in the command. A function in this script is also used
-to render the command formatted correctly as lsf replaces \n with ;'''
+to render the command formatted correctly as lsf replaces \n with ;
+
+The corpus statistics section goes through every saved lsf snapshot to find
+how many commands each word appears in, so that words in nearly every command
+(eg 'module load') can be given less weight when comparing commands.'''
 
 import re
 import csv
+import math
+import multiprocessing
+import os
+from collections import Counter
 
 
 def parseLsfLineBreaks(strToParse):
@@ -44,6 +52,18 @@ def analyseCommand(commandString):
     return getDistribution(getWords(noComments))
 
 
+def weightDistribution(distribution, weights):
+    '''Multiplies the proportion of each word by its weight (1 if it doesn't
+    have one) and rescales so the proportions add up to 1 again'''
+    weighted = dict((word, value * weights.get(word, 1))
+                    for word, value in distribution.items())
+    total = sum(weighted.values())
+    if total == 0:
+        # every word is in every command, compare it on those words anyway
+        return distribution
+    return dict((word, value / total) for word, value in weighted.items())
+
+
 def basicGraph(distribution):
     'Draws a CLI graph of a distribution'
     keys = []
@@ -76,49 +96,90 @@ def difference(dist1, dist2):
     return sumError
 
 
-# ############################### TESTING #####################################
+# ########################### CORPUS STATISTICS ###############################
 
 
-def getLsfCommandsInDB():
-    'Returns the commands saved in the django database lsf files'
+def iterLsfSnapshotNames():
+    '''Yields the name of each saved lsf csv. Crashes with identical
+    snapshots share a file in the blob store so it is only counted once.'''
     from .models import CrashEvent
-    CMD_INDEX = 12
-    cmds = []
-    for crash in CrashEvent.objects.all():
-        try:
-            # change from the default of 'rb'
-            crash.lsfData.read()
-            crash.lsfData.close()
-            crash.lsfData.open(mode="r")
-            crash.lsfData.seek(0)
-        except ValueError as e:
-            pass
-        else:
-            for i, row in enumerate(csv.reader(crash.lsfData)):
-                if i > 0:  # exclude headers
-                    cmds.append(row[CMD_INDEX])
-            crash.lsfData.close()
-    return cmds
-
-
-def go():
-    'A function to parse the data quicker'
-    a = getLsfCommandsInDB()
-    b = [analyseCommand(c) for c in a]
-    return a, b
-
-
-def buildMostCommonWords():
+    return (CrashEvent.objects.exclude(lsfData="").order_by()
+            .values_list("lsfData", flat=True).distinct().iterator())
+
+
+def iterSnapshotCommands(name):
+    'Yields the commands in a saved lsf csv, reading one line at a time'
+    from .storage import blobStorage
+    from .conf import LSF_FIELDS_INDEX_COMMAND
+    with blobStorage.open(name, "rb") as f:
+        reader = csv.reader(line.decode("utf-8") for line in f)
+        next(reader, None)  # exclude headers
+        for row in reader:
+            yield row[LSF_FIELDS_INDEX_COMMAND]
+
+
+def analyseSnapshot(name):
+    '''Analyses every command in a saved lsf csv. Returns the number of
+    commands, a Counter of the number of commands each word is in and a
+    Counter of the sum of the proportions of each word.'''
+    numCommands = 0
+    documentFrequency = Counter()
+    proportions = Counter()
+    for command in iterSnapshotCommands(name):
+        distribution = analyseCommand(command)
+        numCommands += 1
+        documentFrequency.update(distribution.keys())
+        proportions.update(distribution)
+    return numCommands, documentFrequency, proportions
+
+
+def batches(iterable, size):
+    'Yields lists of up to size items from iterable'
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def corpusStatistics(processes=None):
+    '''Runs analyseSnapshot on every saved lsf csv in a pool of processes
+    (one per core by default) and merges the results. The csvs are streamed
+    in batches so memory doesn't grow with the number of crashes.'''
+    processes = processes or os.cpu_count() or 1
+    numCommands = 0
+    documentFrequency = Counter()
+    proportions = Counter()
+    # forked before the database is queried, the processes only read files
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        for batch in batches(iterLsfSnapshotNames(), processes * 16):
+            for n, df, p in pool.imap_unordered(analyseSnapshot, batch):
+                numCommands += n
+                documentFrequency.update(df)
+                proportions.update(p)
+    return numCommands, documentFrequency, proportions
+
+
+def wordWeights(numCommands, documentFrequency):
+    '''Returns a dictionary of word against a weight from its (smoothed)
+    inverse document frequency, scaled so that a word in no commands would
+    have a weight of 1 and a word in every command a weight of 0'''
+    if numCommands == 0:
+        return {}
+    maxIdf = math.log(1 + numCommands)
+    return dict((word, math.log((1 + numCommands) / (1 + df)) / maxIdf)
+                for word, df in documentFrequency.items())
+
+
+def buildMostCommonWords(processes=None):
     'Create a sorted list of the most common words, for information only'
-    cmds, aCmds = go()
-    largeDict = dict()
-    for aCmd in aCmds:
-        for key, value in aCmd.items():
-            if key in largeDict:
-                largeDict[key] += value
-            else:
-                largeDict[key] = value
-    return sorted(largeDict.items(), key=lambda a: a[1])
+    proportions = corpusStatistics(processes)[2]
+    return sorted(proportions.items(), key=lambda a: a[1])
+
+# ############################### TESTING #####################################
 
 
 def testBounds(aCmds, lower, upper):
@@ -131,3 +192,4 @@ def testBounds(aCmds, lower, upper):
             d = difference(x, y)
             if lower < d < upper and x != {} and y != {}:
                 print(iX, iY, d)
+
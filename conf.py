@@ -19,6 +19,64 @@ assert MIDDLE[0] == "/" and MIDDLE[-1] == "/"
 GANGLIA_ROOT = "http://mgmt.jc.rl.ac.uk/ganglia/graph.php?"
 assert GANGLIA_ROOT[-1] == "?"
 
+# the unix socket that the ingestion daemon (manage.py ingestDaemon) listens
+# on and that monClient.py sends crashes to
+DAEMON_SOCKET = "/var/run/lotus-mon/ingest.sock"
+# how long the daemon waits for a client to send the host (or to read the
+# reply) before dropping the connection, so a stuck client can't hold a worker
+DAEMON_CLIENT_TIMEOUT_SECONDS = 10
+# how long monClient.py waits for the daemon's reply before giving up
+DAEMON_REPLY_TIMEOUT_SECONDS = 300
+# how long the daemon waits for registrations that are running when it is
+# stopped (keep it below the service manager's time before it kills it)
+DAEMON_SHUTDOWN_SECONDS = 20
+
+# the live feed of crashes on the index page (views.crashFeed) checks the
+# database for new crashes every FEED_POLL_SECONDS, sends a keep alive every
+# FEED_KEEPALIVE_SECONDS and ends after FEED_DURATION_SECONDS (the browser
+# then reconnects) so that a web server worker isn't held forever
+FEED_POLL_SECONDS = 2
+FEED_KEEPALIVE_SECONDS = 15
+FEED_DURATION_SECONDS = 300
+# crashes that completed up to this long before the last one sent are checked
+# again, because a crash can be committed after one that completed later
+# (several workers registering at once)
+FEED_OVERLAP_SECONDS = 30
+
+# the "similar crashes" on the page of a crash (see similarity.py)
+# the number of similar crashes to show
+SIMILAR_TOP_K = 5
+# at most this many candidates (the crashes sharing the most buckets) are
+# compared exactly, so a lookup takes the same time however many crashes
+SIMILAR_MAX_CANDIDATES = 200
+# the length of the MinHash signature and the number of bands it is split
+# into. With 60 hashes in 20 bands of 3, crashes with a similarity of 0.37
+# have a 50% chance of being found (more similar, much more likely).
+# Run 'manage.py rebuildSignatures' after changing these.
+SIMILAR_NUM_HASHES = 60
+SIMILAR_BANDS = 20
+
+# a registration for a host that has a crash being registered, or one that
+# finished less than COALESCE_WINDOW_SECONDS ago, returns that crash straight
+# away rather than querying lsf and ganglia again (see mon.runThroughCrash)
+COALESCE_WINDOW_SECONDS = 300
+# a registration unfinished this long after it started is assumed to have
+# died (eg the daemon was killed) and the next registration for the host
+# queries lsf and ganglia itself
+COALESCE_STALE_SECONDS = 600
+# how long a registration that found a crash still being registered waits
+# for it to finish (checking every COALESCE_POLL_SECONDS) before returning
+# it anyway. The caller (a daemon worker, a web request or a node hook) is
+# held while waiting so keep this short, 0 doesn't wait.
+COALESCE_WAIT_SECONDS = 0
+COALESCE_POLL_SECONDS = 1
+
+# when comparing commands (models.addToSavedCommands), give less weight to
+# words that are in most commands (eg 'module load') using the weights saved
+# by 'manage.py buildCorpusStatistics'. Run it with --reweight after turning
+# this on or off so the saved commands are weighted the same way.
+COMMAND_WORD_WEIGHTS = False
+
 # a list of lsf fields to use
 # possibilities:
 # ["jobid", "stat", "user", "queue", "job_description", "job_name",
@@ -0,0 +1,41 @@
+import json
+import tempfile
+import shutil
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from monitor.benchmark import DEFAULTS, runBenchmarks
+
+
+class Command(BaseCommand):
+    help = ('Times crash ingestion and the pages against synthetic lsf and '
+            'ganglia data in a throw away database. Prints json.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--label', default="", type=str,
+                            help='a name for this run eg the git version')
+        parser.add_argument('--output', default=None, type=str,
+                            help='write the json here instead of stdout')
+        for key, value in DEFAULTS.items():
+            parser.add_argument('--' + key, default=None, type=type(value),
+                                help='default {}'.format(value))
+
+    def handle(self, *args, **options):
+        mediaRoot = tempfile.mkdtemp(prefix="lotus-mon-benchmark-")
+        # create a fresh test database so the real data is never touched
+        oldName = connection.creation.create_test_db(verbosity=0,
+                                                     autoclobber=True)
+        try:
+            with override_settings(MEDIA_ROOT=mediaRoot):
+                results = runBenchmarks(
+                    label=options["label"],
+                    **dict((key, options[key]) for key in DEFAULTS))
+        finally:
+            connection.creation.destroy_test_db(oldName, verbosity=0)
+            shutil.rmtree(mediaRoot, ignore_errors=True)
+        text = json.dumps(results, indent=2, sort_keys=True)
+        if options["output"] is None:
+            self.stdout.write(text)
+        else:
+            with open(options["output"], "w") as f:
+                f.write(text + "\n")
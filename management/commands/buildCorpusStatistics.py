@@ -0,0 +1,57 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction, IntegrityError
+from monitor import commandAnalyse
+from monitor.models import WordWeight, analyseCommandText
+from monitor.models import Command as SavedCommand
+
+
+class Command(BaseCommand):
+    help = ('Counts how many saved lsf commands each word is in (in parallel) '
+            'and saves the weights used to down-weight common words')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', default=None, type=int,
+                            help='default one per core')
+        parser.add_argument('--min-commands', default=2, type=int,
+                            help="words in fewer commands aren't saved (they "
+                                 "get a weight of 1 anyway)")
+        parser.add_argument('--reweight', action='store_true',
+                            help='recalculate the distributions of the saved '
+                                 'commands afterwards')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        numCommands, documentFrequency, proportions = \
+            commandAnalyse.corpusStatistics(options["processes"])
+        weights = commandAnalyse.wordWeights(numCommands, documentFrequency)
+        # longer words can't be saved, they are very unlikely to be common
+        saved = [WordWeight(word=word, documentFrequency=df,
+                            weight=weights[word])
+                 for word, df in documentFrequency.items()
+                 if df >= options["min_commands"] and len(word) <= 255]
+        with transaction.atomic():
+            WordWeight.objects.all().delete()
+            WordWeight.objects.bulk_create(saved, batch_size=500)
+        print("Analysed {} commands in {:.1f}s, saved weights of {} of {} "
+              "words".format(numCommands, time.perf_counter() - start,
+                             len(saved), len(documentFrequency)))
+        print("Most common words:")
+        for word, df in documentFrequency.most_common(10):
+            print("    {} in {} commands, weight {:.3f}".format(
+                word, df, weights[word]))
+        if options["reweight"]:
+            self.reweightCommands()
+
+    def reweightCommands(self):
+        'Recalculates the distribution of every saved command'
+        numFailed = 0
+        for command in SavedCommand.objects.iterator():
+            command.setDistribution(analyseCommandText(command.text))
+            try:
+                with transaction.atomic():
+                    command.save(update_fields=["distribution"])
+            except IntegrityError:
+                # another command now has the same distribution
+                numFailed += 1
+        print("Reweighted the saved commands ({} failed)".format(numFailed))
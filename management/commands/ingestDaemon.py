@@ -0,0 +1,135 @@
+import json
+import os
+import re
+import signal
+import sys
+import time
+import socketserver
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from monitor.conf import (DAEMON_SOCKET, DAEMON_CLIENT_TIMEOUT_SECONDS,
+                          DAEMON_SHUTDOWN_SECONDS)
+from monitor.mon import runThroughCrash
+
+# the same hosts that can be registered through the url
+HOST_PATTERN = re.compile(r'^host[0-9]{3}\.jc\.rl\.ac\.uk$')
+
+
+class RegistrationHandler(socketserver.StreamRequestHandler):
+    '''Handles one registration. The client sends the host address on a single
+    line and gets back a single line of json:
+        {"ok": true, "crash": <crash id>, "completed": <false if another
+         registration of the host is still saving it>,
+         "seconds": <time to register>}
+        {"ok": false, "error": <message>, "seconds": <time taken>}'''
+
+    # applied to the accepted socket, a client that connects and never sends
+    # anything times out instead of holding a worker thread forever
+    timeout = DAEMON_CLIENT_TIMEOUT_SECONDS
+
+    def handle(self):
+        start = time.perf_counter()
+        try:
+            host = self.rfile.readline().decode("utf-8").strip()
+        except OSError as e:
+            # includes the socket timing out
+            print("Dropped a client that didn't send a host: {}".format(e))
+            return
+        try:
+            if HOST_PATTERN.match(host) is None:
+                raise ValueError("Not a valid host: '{}'".format(host))
+            # the daemon lives much longer than a database connection may, so
+            # drop it if it has gone stale (django does this per request)
+            close_old_connections()
+            crash = runThroughCrash(host)
+        except Exception as e:
+            reply = {"ok": False, "error": "{}: {}".format(type(e).__name__,
+                                                            e)}
+        else:
+            # not completed if another registration of the host is still
+            # querying lsf and ganglia
+            reply = {"ok": True, "crash": crash.pk,
+                     "completed": crash.completedAt is not None}
+        reply["seconds"] = time.perf_counter() - start
+        print("Registration of {} took {:.3f}s: {}".format(host,
+                                                          reply["seconds"],
+                                                          reply))
+        self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+
+class PooledUnixStreamServer(socketserver.UnixStreamServer):
+    '''A unix socket server that handles requests in a fixed pool of threads.
+    Each thread keeps its own database connection open between requests.'''
+
+    def __init__(self, path, handler, workers):
+        super().__init__(path, handler)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.futures = set()  # the requests queued or being handled
+        self.stopping = False
+
+    def process_request(self, request, client_address):
+        future = self.pool.submit(self.processRequestInThread, request,
+                                  client_address)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+
+    def processRequestInThread(self, request, client_address):
+        try:
+            if not self.stopping:
+                # requests still queued when stopping are dropped, the client
+                # sees the connection close
+                self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def stop(self, timeout):
+        '''Stops accepting connections (removing the socket), drops the
+        queued requests and waits up to timeout seconds for the ones being
+        handled. Returns the number still running.'''
+        self.stopping = True
+        self.server_close()
+        os.remove(self.server_address)
+        self.pool.shutdown(wait=False)
+        running = wait(list(self.futures), timeout=timeout).not_done
+        return len(running)
+
+
+class Command(BaseCommand):
+    help = ('Runs a long lived process that registers crashes sent to it over '
+            'a unix socket by monClient.py')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=DAEMON_SOCKET, type=str)
+        parser.add_argument('--workers', default=4, type=int,
+                            help='number of crashes to register at once')
+
+    def handle(self, *args, **options):
+        path = options["socket"]
+        if os.path.exists(path):
+            # left over from a previous daemon that didn't shut down cleanly
+            os.remove(path)
+        # ingestion is safe to run concurrently (see
+        # monitor.models.addToSavedCommands) so several crashes can be
+        # registered at once during mass failures
+        server = PooledUnixStreamServer(path, RegistrationHandler,
+                                        options["workers"])
+        # exit cleanly (removing the socket) when stopped by a service manager
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        print("Listening on {}".format(path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            running = server.stop(DAEMON_SHUTDOWN_SECONDS)
+            if running:
+                # the pool's threads would be waited for at exit. Their
+                # crashes are left unfinished and are ignored once they are
+                # COALESCE_STALE_SECONDS old.
+                print("Exiting with {} requests unfinished".format(
+                    running))
+                sys.stdout.flush()
+                os._exit(1)
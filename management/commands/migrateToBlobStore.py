@@ -0,0 +1,59 @@
+import os
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from monitor.models import CrashEvent, GangliaGraph
+from monitor.storage import (blobStorage, spaceReport, collectUnusedBlobs,
+                             BLOB_DIR)
+
+
+def formatBytes(numBytes):
+    'formats a number of bytes in MB with 1dp'
+    return "{:.1f}MB".format(numBytes / 10 ** 6)
+
+
+class Command(BaseCommand):
+    help = ('Moves the files saved before the blob store into it (removing '
+            'the originals), removes stored files that nothing uses any more '
+            'and reports the space saved')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report-only', action='store_true',
+                            help="don't move any files, just report")
+
+    def handle(self, *args, **options):
+        if not options["report_only"]:
+            before, moved = 0, 0
+            for model, fieldName in ((CrashEvent, "lsfData"),
+                                     (GangliaGraph, "image")):
+                objects = (model.objects.exclude(**{fieldName: ""})
+                           .exclude(**{fieldName + "__startswith": BLOB_DIR}))
+                for obj in objects.iterator():
+                    oldName = getattr(obj, fieldName).name
+                    oldPath = os.path.join(settings.MEDIA_ROOT, oldName)
+                    if not os.path.isfile(oldPath):
+                        print("Missing file for {} {}: {}".format(
+                            model.__name__, obj.pk, oldName))
+                        continue
+                    with open(oldPath, "rb") as f:
+                        data = f.read()
+                    # the old name keeps the extension so csvs get compressed
+                    newName = blobStorage.save(oldName, ContentFile(data))
+                    # update without save() so no other fields are touched
+                    model.objects.filter(pk=obj.pk).update(
+                        **{fieldName: newName})
+                    os.remove(oldPath)
+                    try:
+                        # remove the host/id directories once empty
+                        os.removedirs(os.path.dirname(oldPath))
+                    except OSError:
+                        pass
+                    before += len(data)
+                    moved += 1
+            print("Moved {} files ({})".format(moved, formatBytes(before)))
+            print("Removed {} unused files".format(collectUnusedBlobs()))
+        report = spaceReport()
+        print("Blob store: {} files, {} of content stored in {}, saving {}"
+              .format(report["blobs"], formatBytes(report["logical"]),
+                      formatBytes(report["stored"]),
+                      formatBytes(report["saved"])))
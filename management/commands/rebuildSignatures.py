@@ -0,0 +1,17 @@
+import time
+from django.core.management.base import BaseCommand
+from monitor.models import CrashEvent, updateSignature
+
+
+class Command(BaseCommand):
+    help = ('Recalculates the signatures used to find similar crashes for '
+            'every crash (eg for crashes saved before they were added)')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        numCrashes = 0
+        for crash in CrashEvent.objects.iterator():
+            updateSignature(crash)
+            numCrashes += 1
+        print("Rebuilt the signatures of {} crashes in {:.1f}s".format(
+            numCrashes, time.perf_counter() - start))
@@ -6,7 +6,7 @@ class Command(BaseCommand):
     help = 'Registers a crash on a specified host'
 
     def add_arguments(self, parser):
-        parser.add_argument('host_address', nargs='1', type=str)
+        parser.add_argument('host_address', nargs=1, type=str)
 
     def handle(self, *args, **options):
         addr = options["host_address"][0]
@@ -0,0 +1,42 @@
+import json
+import tempfile
+import shutil
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from monitor.benchmark import runStressTest
+
+
+class Command(BaseCommand):
+    help = ('Registers synthetic crashes from several processes at once in a '
+            'throw away database and checks none are lost or duplicated. '
+            'Prints json and fails if there were any problems.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default=8, type=int)
+        parser.add_argument('--crashesPerWorker', default=5, type=int)
+        parser.add_argument('--jobs', default=10, type=int)
+        parser.add_argument('--commands', default=10, type=int)
+
+    def handle(self, *args, **options):
+        mediaRoot = tempfile.mkdtemp(prefix="lotus-mon-stress-")
+        oldName = connection.creation.create_test_db(verbosity=0,
+                                                     autoclobber=True)
+        try:
+            testName = connection.settings_dict["NAME"]
+            if ":memory:" in testName or "mode=memory" in testName:
+                # the worker processes wouldn't see the same database
+                raise CommandError("The test database is in memory, set a "
+                                   "TEST NAME in the database settings")
+            with override_settings(MEDIA_ROOT=mediaRoot):
+                results = runStressTest(
+                    workers=options["workers"],
+                    crashesPerWorker=options["crashesPerWorker"],
+                    jobs=options["jobs"], commands=options["commands"])
+        finally:
+            connection.creation.destroy_test_db(oldName, verbosity=0)
+            shutil.rmtree(mediaRoot, ignore_errors=True)
+        self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        if not results["ok"]:
+            raise CommandError("{} problems found".format(
+                len(results["problems"])))
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q, Count
 from django.dispatch import receiver  # for catching deleted database objects
 from monitor.conf import (GANGLIA_TIMES_DEFAULT, GANGLIA_BASIC_DEFAULT,
                           GANGLIA_REPORTS_DEFAULT, LSF_FIELDS_INDEX_COMMAND,
@@ -9,7 +10,9 @@ import os
 from io import StringIO  # for writing to a buffer before using django file
 import csv  # to save the lsf output
 from django.core.files.base import File  # for saving files to database
-from monitor import commandAnalyse
+from monitor import commandAnalyse, similarity
+from monitor.conf import SIMILAR_MAX_CANDIDATES, COMMAND_WORD_WEIGHTS
+from monitor.storage import blobStorage
 import json
 
 
@@ -27,13 +30,62 @@ class Host(models.Model):
         return self.address
 
 
+def retryOnIntegrityError(function, attempts=5):
+    '''Calls function and returns the result, calling it again if it fails an
+    integrity check because another process registering a crash at the same
+    time made the same change first. function must make its changes in its
+    own savepoint (as get_or_create does).'''
+    for attempt in range(attempts):
+        try:
+            return function()
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
+            print("Integrity error, retrying")
+
+
+def insertIgnoringConflict(model, **fields):
+    '''Inserts a row unless an identical unique row exists, eg a many to many
+    link that another process added at the same time. Only writing (rather
+    than reading first like .add() does) keeps the transaction short.
+    Integrity errors for any other reason are raised.'''
+    try:
+        with transaction.atomic():
+            model.objects.create(**fields)
+    except IntegrityError:
+        if not model.objects.filter(**fields).exists():
+            raise
+
+
+def getOrCreateByName(model, name):
+    'get_or_create for the User and Queue models that is safe to race'
+    return retryOnIntegrityError(
+        lambda: model.objects.get_or_create(name=name)[0])
+
+
+def analyseCommandText(commandText):
+    '''Returns the word distribution of a command, down-weighting the words
+    that are in most commands if COMMAND_WORD_WEIGHTS is on'''
+    distribution = commandAnalyse.analyseCommand(commandText)
+    if COMMAND_WORD_WEIGHTS:
+        weights = dict(WordWeight.objects.filter(word__in=list(distribution))
+                       .values_list("word", "weight"))
+        distribution = commandAnalyse.weightDistribution(distribution,
+                                                         weights)
+    return distribution
+
+
 def addToSavedCommands(commandText, user, crash):
     '''Takes information about a command from lsf and updates a similar
     command with the new data (if there is one). Otherwise, a new command is
     created with this data. The user and crash should be django database
-    instances'''
+    instances
+
+    This is safe to call from several processes at once: the scan for a
+    similar command isn't in a transaction and if two processes both create
+    the same command the loser links to the winner's command instead.'''
     # create a word distribution
-    distribution = commandAnalyse.analyseCommand(commandText)
+    distribution = analyseCommandText(commandText)
     # this acts as a tollerance as nothing is saved unless its diffence is
     # smaller than this
     lowestDifference = 0.7
@@ -53,17 +105,30 @@ def addToSavedCommands(commandText, user, crash):
         # if no command was found better than the tollerance then create one
         lowestCommand = Command(text=commandText)
         lowestCommand.setDistribution(distribution)
-        # save it so data can be added later
-        lowestCommand.save()
+        try:
+            # save it so data can be added later, in a savepoint so that a
+            # failure doesn't break any transaction this is called in
+            with transaction.atomic():
+                lowestCommand.save()
+        except IntegrityError:
+            # another process created a command with this text or
+            # distribution since the scan above, so use that one
+            lowestCommand = Command.objects.filter(
+                Q(text=commandText) |
+                Q(distribution=lowestCommand.distribution)).first()
+            if lowestCommand is None:
+                raise
+            print("Linking to command created concurrently")
     else:
-        print("Linking to command {}".format(command.text[0:50]))
+        print("Linking to command {}".format(lowestCommand.text[0:50]))
     # add the user and the crash event to the command associated with this text
     # if the user or crash is already in the list then this command does
     # nothing
-    lowestCommand.users.add(user)
+    insertIgnoringConflict(Command.users.through, command=lowestCommand,
+                           user=user)
     print("Linked Command to user {}".format(user.name))
-    lowestCommand.crashes.add(crash)
-    lowestCommand.save()
+    insertIgnoringConflict(Command.crashes.through, command=lowestCommand,
+                           crashevent=crash)
 
 
 def getUploadDir(instance):
@@ -85,7 +150,8 @@ def getUploadDir(instance):
 def getUploadPath(instance, filename=""):
     'function to get the file save path from a class instance'
     # filename should be overwritten, it is just passed in by django
-    # file uploaded to MEDIA_ROOT/host/id/<filename>
+    # this was where files were uploaded to (MEDIA_ROOT/host/id/<filename>),
+    # now the blob store (monitor.storage) only uses the extension
     n = type(instance).__name__
     if n == "CrashEvent":
         filename = instance.LSF_NAME
@@ -102,14 +168,20 @@ class CrashEvent(models.Model):
         - date = date of registering crash
         - host = the host object that the crash occured on
         - lsfCommonEnding = info about where to find the csv file of lsf data
+        - completedAt = when all the data was saved (None if the crash is
+                        still being registered or was before this was added)
         - gangliagraph_set = associated ganglia graphs
         - user_set = associated user objects according to lsf
         - command_set = associated command objects according to lsf'''
     # lsf name for use when saving a file
     LSF_NAME = "lsf.csv"
-    date = models.DateTimeField('Occurred At')
+    # indexed as the pages and the admin sort and group crashes by date
+    date = models.DateTimeField('Occurred At', db_index=True)
     host = models.ForeignKey(Host, on_delete=models.CASCADE)
-    lsfData = models.FileField(upload_to=getUploadPath)
+    lsfData = models.FileField(upload_to=getUploadPath, storage=blobStorage)
+    # indexed because the live feed (views.crashFeed) polls for new values
+    completedAt = models.DateTimeField('Completed At', null=True, blank=True,
+                                       db_index=True)
 
     def setupLsfData(self, data, headers):
         '''sets up the class based on the parsed lsf data
@@ -142,23 +214,68 @@ class CrashEvent(models.Model):
             # Step through each row of data (one for each job)
             # create / update the queue
             thisQueue = row[LSF_FIELDS_INDEX_QUEUE]
-            queue, justCreated = Queue.objects.get_or_create(name=thisQueue)
-            if justCreated:
-                queue.save()
-            self.queue_set.add(queue)
+            queue = getOrCreateByName(Queue, thisQueue)
+            insertIgnoringConflict(Queue.crashes.through, queue=queue,
+                                   crashevent=self)
             print("Linked to queue {}".format(thisQueue))
             # create / update a user
             thisUser = row[LSF_FIELDS_INDEX_USER]
-            user, justCreated = User.objects.get_or_create(name=thisUser)
-            if justCreated:
-                user.save()
-            self.user_set.add(user)
+            user = getOrCreateByName(User, thisUser)
+            insertIgnoringConflict(User.crashes.through, user=user,
+                                   crashevent=self)
             print("Linked to user {}".format(thisUser))
             # create / update this command
             addToSavedCommands(row[LSF_FIELDS_INDEX_COMMAND], user, self)
             # No need to save the crash event itself because this should be
             # called from mon.py which saves this database later.
 
+    def getLsfRows(self):
+        '''Returns the rows of the saved lsf csv (the first row is the
+        headers) or None if there is no lsf data for this crash'''
+        if not self.lsfData:
+            return None
+        # the csv may be compressed so open through the storage in binary
+        # and decode here
+        with self.lsfData.storage.open(self.lsfData.name, "rb") as f:
+            text = f.read().decode("utf-8")
+        return list(csv.reader(StringIO(text, newline="")))
+
+    def getSimilarityFeatures(self):
+        '''Returns the set of things that similar crashes are compared by:
+        the host and the users, queues and commands (clusters) of the crash'''
+        features = {"h:{}".format(self.host_id)}
+        for prefix, related in (("u", self.user_set), ("q", self.queue_set),
+                                ("c", self.command_set)):
+            features.update("{}:{}".format(prefix, pk)
+                            for pk in related.values_list("pk", flat=True))
+        return features
+
+    def getSimilarCrashes(self, k):
+        '''Returns up to k (similarity, crash) pairs of the most similar other
+        crashes, most similar first. Uses the buckets saved by updateSignature
+        to find candidates so doesn't look at every crash.'''
+        buckets = SignatureBand.objects.filter(crash=self).values_list(
+            "band", "bucket")
+        query = Q()
+        for band, bucket in buckets:
+            query |= Q(band=band, bucket=bucket)
+        if not query:
+            # no signature yet (see rebuildSignatures)
+            return []
+        # the crashes sharing the most buckets are likely the most similar
+        candidates = (SignatureBand.objects.filter(query).exclude(crash=self)
+                      .values("crash").annotate(matches=Count("crash"))
+                      .order_by("-matches")[:SIMILAR_MAX_CANDIDATES])
+        features = self.crashsignature.getFeatures()
+        scored = [(similarity.jaccard(features, signature.getFeatures()),
+                   signature.crash)
+                  for signature in CrashSignature.objects.filter(
+                      crash__in=[c["crash"] for c in candidates])
+                  .select_related("crash__host")]
+        # most similar first, then newest first
+        scored.sort(key=lambda s: (s[0], s[1].date), reverse=True)
+        return scored[:k]
+
     def __str__(self):
         'formats the class as a string for command line / admin panel'
         return "{} at {}".format(self.host.address, self.date)
@@ -251,7 +368,7 @@ class GangliaGraph(models.Model):
     # commonEnding is the shared part of the URL and save path for this file
     # <PATH_TO_SAVE><commonEnding> = save path
     # <BASE_URL><commonEnding>     = url
-    image = models.FileField(upload_to=getUploadPath)
+    image = models.FileField(upload_to=getUploadPath, storage=blobStorage)
     # get the plot types from the conf file
     plotTypes = GANGLIA_BASIC_DEFAULT + GANGLIA_REPORTS_DEFAULT
     plotTypeChoices = [(plotType, plotType) for plotType in plotTypes]
@@ -270,20 +387,105 @@ class GangliaGraph(models.Model):
         return "Graph: {} over {}".format(self.plotType, self.timePeriod)
 
 
+class CrashSignature(models.Model):
+    '''A database model for the data used to find similar crashes (see
+    monitor.similarity), saved by updateSignature.
+        - crash = the crash this is the signature of
+        - features = the features of the crash (stored using json)
+        - minHash = the MinHash signature of the features (stored using
+                    json), its bands are the SignatureBand objects'''
+    crash = models.OneToOneField(CrashEvent, on_delete=models.CASCADE,
+                                 primary_key=True)
+    features = models.TextField("Json Features")
+    minHash = models.TextField("Json MinHash")
+
+    def getFeatures(self):
+        return set(json.loads(self.features))
+
+    def __str__(self):
+        return "Signature of crash {}".format(self.crash_id)
+
+
+class SignatureBand(models.Model):
+    '''A database model for one band of the MinHash signature of a crash.
+    Crashes with the same bucket in the same band are likely to be similar so
+    (band, bucket) is indexed for looking them up.
+        - crash = the crash this is part of the signature of
+        - band = the number of the band
+        - bucket = the hash of the values of the signature in this band'''
+    crash = models.ForeignKey(CrashEvent, on_delete=models.CASCADE)
+    band = models.PositiveSmallIntegerField("Band")
+    bucket = models.BigIntegerField("Bucket")
+
+    class Meta:
+        index_together = [("band", "bucket")]
+
+
+def updateSignature(crash):
+    '''Saves the signature of a crash used to find similar crashes,
+    replacing any old one. Should be called once its users, queues and
+    commands are linked.'''
+    features = crash.getSimilarityFeatures()
+    signature = similarity.minHash(features)
+    # each statement is a separate short write rather than one transaction,
+    # a lookup in between finds no (or fewer) similar crashes for this one
+    SignatureBand.objects.filter(crash=crash).delete()
+    CrashSignature.objects.filter(crash=crash).delete()
+    CrashSignature.objects.create(crash=crash,
+                                  features=json.dumps(sorted(features)),
+                                  minHash=json.dumps(signature))
+    SignatureBand.objects.bulk_create([
+        SignatureBand(crash=crash, band=band, bucket=bucket)
+        for band, bucket in similarity.bandBuckets(signature)])
+
+
+class WordWeight(models.Model):
+    '''A database model for how common a word is in the saved lsf commands,
+    saved by 'manage.py buildCorpusStatistics' (see commandAnalyse).
+        - word = the word
+        - documentFrequency = the number of commands the word is in
+        - weight = how much the word counts when comparing commands, from 1
+                   for a word in no commands to 0 for a word in every
+                   command'''
+    word = models.CharField("Word", max_length=255, unique=True)
+    documentFrequency = models.IntegerField("Document Frequency")
+    weight = models.FloatField("Weight")
+
+    def __str__(self):
+        return "{}: {:.3f}".format(self.word, self.weight)
+
+
+class Blob(models.Model):
+    '''A database model for a file in the content addressed store (see
+    monitor.storage).
+        - key = the name of the file under MEDIA_ROOT (from its content hash)
+        - size = the size of the content in bytes
+        - storedSize = the size on disk in bytes (smaller if compressed)
+        - references = the number of file fields that use this file'''
+    key = models.CharField("Key", max_length=100, unique=True)
+    size = models.BigIntegerField("Size")
+    storedSize = models.BigIntegerField("Stored Size")
+    references = models.IntegerField("References", default=0)
+
+    def __str__(self):
+        return "{} x{}".format(self.key, self.references)
+
+
 @receiver(models.signals.pre_delete)
 def autoDeleteFile(sender, instance, **kwargs):
-    'Deletes the file on disk when the database object is deleted'
+    '''Releases the file when the database object is deleted. Files in the
+    blob store are only deleted from disk once nothing references them.'''
     className = sender.__name__  # eg 'GangliaGraph'
     if className in ("GangliaGraph", "CrashEvent"):
         # if the class is one with a file
         if sender.__name__ == "GangliaGraph":
-            # if its a ganlia graph then we can just delete the file
-            filePath = os.path.join(settings.MEDIA_ROOT,
-                                    getUploadPath(instance))
-            if os.path.isfile(filePath):
-                os.remove(filePath)
+            fieldFile = instance.image
         elif sender.__name__ == "CrashEvent":
-            # if its a crash event then delete the whole directory
+            fieldFile = instance.lsfData
+        if fieldFile:
+            fieldFile.storage.delete(fieldFile.name)
+        if sender.__name__ == "CrashEvent":
+            # crashes saved before the blob store have their own directory
             fileDir = os.path.join(settings.MEDIA_ROOT,
                                    getUploadDir(instance))
             if os.path.isdir(fileDir):
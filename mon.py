@@ -8,53 +8,96 @@ DEPENDS on the wrapper script 'bjobsLSF.sh' which sources the lsf profile.
 
 # ------------------------------- DEPENDENCIES -------------------------------
 # STANDARD IMPORTS (should come included with python3)
+import sys
 from sys import argv  # for parsing command line inputs
 from subprocess import check_output  # for calling bjobs
 from re import finditer, escape  # for parsing the lsf results
 from io import BytesIO
+from datetime import timedelta
 import os
+import threading
+import time
 
 # PIP IMPORTS (need to be installed with pip3)
 # django, requests
+import django
+
+if __name__ == "__main__":
+    # run as a script ('python3 mon.py host') rather than from django, so
+    # django has to be set up before the models can be imported. The project
+    # (the directory above this app) has to be importable as well.
+    if "DJANGO_SETTINGS_MODULE" not in os.environ:
+        exit("Set DJANGO_SETTINGS_MODULE to the settings of the django "
+             "project (eg 'lotus.settings') to run mon.py as a script")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    django.setup()
+
 import requests  # for downloading ganglia plots
 from django.utils import timezone  # for recording django times
 from django.core.files.base import File  # for saving files to database
+from django.db import transaction
+from django.db.models import Q
 
 # LOCAL IMPORTS (other files)
-from monitor.models import CrashEvent, Host  # models for db
+from monitor.models import (CrashEvent, Host,  # models for db
+                            retryOnIntegrityError, updateSignature)
 # app level configuration
 from monitor.conf import (GANGLIA_ROOT, LSF_FIELDS, GANGLIA_TIMES,
-                          GANGLIA_REPORTS, GANGLIA_BASIC)
+                          GANGLIA_REPORTS, GANGLIA_BASIC,
+                          COALESCE_WINDOW_SECONDS, COALESCE_STALE_SECONDS,
+                          COALESCE_POLL_SECONDS, COALESCE_WAIT_SECONDS)
+
+# a session keeps the connection to ganglia open between graphs (and between
+# crashes when running inside the ingestion daemon). Sessions aren't thread
+# safe and the daemon registers crashes in several threads, so each thread
+# gets its own (see getGangliaSession)
+gangliaSessions = threading.local()
 
 
 # ---------------------------- FUNCTIONS --------------------------------------
 
 
-def runThroughCrash(hostAddress):
-    'The base function that handles a crash by calling other functions'
+def runThroughCrash(hostAddress, waitSeconds=COALESCE_WAIT_SECONDS):
+    '''The base function that handles a crash by calling other functions.
+    Returns the saved CrashEvent.
+
+    If the host already has a crash being registered, or one that finished
+    less than COALESCE_WINDOW_SECONDS ago (eg the alert fired twice), that
+    crash is returned straight away instead of registering another one. Its
+    completedAt is None if it is still being registered, unless it finishes
+    within waitSeconds.'''
     print("Starting up")
-    hostDB, isNew = Host.objects.get_or_create(address=hostAddress)
-    if isNew:
-        hostDB.save()
+    hostDB = retryOnIntegrityError(
+        lambda: Host.objects.get_or_create(address=hostAddress)[0])
     hostName = hostDB.getHostName()  # split off the 'hostXYZ' from the address
     print("Looking at host: {} <=> {}".format(hostName, hostAddress))
-    # create a django db instance
-    crashEvent = CrashEvent(date=timezone.now(), host=hostDB)
+    while True:
+        crashEvent, isNew = claimRegistration(hostDB)
+        if isNew:
+            break
+        print("Crash {} is already registered for this host, returning it"
+              .format(crashEvent.pk))
+        if crashEvent.completedAt is not None or waitSeconds <= 0:
+            return crashEvent
+        crashEvent = waitForRegistration(crashEvent, waitSeconds)
+        if crashEvent is not None:
+            return crashEvent
+        print("That registration failed, trying again")
     print("Created crash event")
-    # the save here is required (so it gets an id and later we can add ganglia)
-    try:
-        crashEvent.save()
-    except BaseException as e:
-        print("ERROR on save:", e)
-        raise
     try:
         # get and save the lsf results
         print("before query lsf")
         queryLsf(hostAddress, crashEvent)
         # get and save the ganglia results
         queryGanglia(hostAddress, crashEvent)
+        # so that similar crashes can be found quickly
+        updateSignature(crashEvent)
+        # mark it as complete so it appears in the live feed
+        crashEvent.completedAt = timezone.now()
         crashEvent.save()  # save the database changes
         print("Database instance saved")
+        return crashEvent
     except BaseException as e:
         # if there is an error then delete the crash event so that a broken
         # half copy isn't hanging around...
@@ -65,6 +108,56 @@ def runThroughCrash(hostAddress):
         raise
 
 
+def claimRegistration(hostDB):
+    '''Returns (crash, False) if the host has a crash being registered or one
+    that finished less than COALESCE_WINDOW_SECONDS ago. Otherwise creates a
+    new crash for the host and returns (crash, True).'''
+    now = timezone.now()
+    with transaction.atomic():
+        # writing to the host row locks it until the end of this (short)
+        # transaction on every database (select_for_update does nothing on
+        # sqlite), so two registrations can't both decide to create a crash
+        Host.objects.filter(pk=hostDB.pk).update(address=hostDB.address)
+        recent = (CrashEvent.objects.filter(host=hostDB).filter(
+            Q(completedAt__gte=now - timedelta(
+                seconds=COALESCE_WINDOW_SECONDS)) |
+            # older unfinished crashes are from registrations that died
+            Q(completedAt__isnull=True, date__gte=now - timedelta(
+                seconds=COALESCE_STALE_SECONDS)))
+            .order_by("-date").first())
+        if recent is not None:
+            return recent, False
+        # the save here is required (so it gets an id and later we can add
+        # ganglia)
+        crashEvent = CrashEvent(date=now, host=hostDB)
+        crashEvent.save()
+    return crashEvent, True
+
+
+def waitForRegistration(crashEvent, waitSeconds):
+    '''Waits up to waitSeconds for a crash that is being registered by
+    another process to be finished. Returns the crash (finished or not), or
+    None if that registration failed.'''
+    start = time.monotonic()
+    while crashEvent.completedAt is None:
+        if time.monotonic() - start > waitSeconds:
+            return crashEvent
+        time.sleep(COALESCE_POLL_SECONDS)
+        try:
+            crashEvent.refresh_from_db(fields=["completedAt"])
+        except CrashEvent.DoesNotExist:
+            # it failed and was deleted
+            return None
+    return crashEvent
+
+
+def getGangliaSession():
+    'Returns the requests session to ganglia of this thread'
+    if not hasattr(gangliaSessions, "session"):
+        gangliaSessions.session = requests.Session()
+    return gangliaSessions.session
+
+
 def queryLsf(host, crashEvent):
     '''Queries lsf and saves the information to csv.
         - host as string 'hostABC.jc.rl.ac.uk'
@@ -123,6 +216,18 @@ def queryLsf(host, crashEvent):
         # if there is no actual output then don't save any lsf data
         print("No lsf data for this crash, not saving any")
         raise
+    data, headers = parseBjobsOutput(lines, delimiter)
+    print("Parsed lsf data")
+    crashEvent.setupLsfData(data, headers)  # save it to the database
+
+
+def parseBjobsOutput(lines, delimiter="|"):
+    '''Parses the fixed width output of bjobs (see queryLsf) into a list of
+    rows and a list of headers.
+        - lines = the lines of output, or the whole output as one string
+        - delimiter = the delimiter that was passed to bjobs'''
+    if isinstance(lines, str):
+        lines = lines.strip().split("\n")
     header = lines[0]
     # check that the correct number of fields were returned
     assert header.count(delimiter) == len(LSF_FIELDS) - 1
@@ -146,8 +251,7 @@ def queryLsf(host, crashEvent):
             lastIndex = index
         data.append(cells)
     headers = [cell.strip() for cell in header.split(delimiter)]
-    print("Parsed lsf data")
-    crashEvent.setupLsfData(data, headers)  # save it to the database
+    return data, headers
 
 
 def queryGanglia(hostAddress, crashEvent):
@@ -179,7 +283,7 @@ def queryGanglia(hostAddress, crashEvent):
             url = (GANGLIA_ROOT + qs + extra)
             print("Ganglia get {}".format(extra))
             # download the image to a file
-            response = requests.get(url).content
+            response = getGangliaSession().get(url).content
             totalBytesDownloaded += len(response)  # add to the total
             output = BytesIO()
             output.write(response)
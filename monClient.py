@@ -0,0 +1,63 @@
+# -------------------------------- DOC STRING ---------------------------------
+
+'''A tiny client to register a crash with the ingestion daemon
+('manage.py ingestDaemon'). This replaces calling 'manage.py registerCrash' or
+'mon.py' from the node health hooks: it doesn't import django or requests so
+it starts almost instantly and the daemon, which already has django, the
+database connection and the ganglia connection ready, does the work.
+
+Usage: python3 monClient.py hostXYZ.jc.rl.ac.uk [socket path]
+
+Prints the crash id and the end to end latency of the registration. Exits
+with 1 if the registration failed.
+'''
+
+# ------------------------------- DEPENDENCIES -------------------------------
+# STANDARD IMPORTS (should come included with python3)
+import sys
+import json
+import socket
+import time
+
+# LOCAL IMPORTS (other files)
+# imported directly (not as monitor.conf) because this is run as a script from
+# this directory, conf has no dependencies so is quick to import
+from conf import DAEMON_SOCKET, DAEMON_REPLY_TIMEOUT_SECONDS
+
+
+# ---------------------------- FUNCTIONS --------------------------------------
+
+
+def register(hostAddress, socketPath=DAEMON_SOCKET):
+    '''Sends the host to the daemon and returns its reply as a dictionary with
+    an extra key 'latency' for the end to end time in seconds.'''
+    start = time.perf_counter()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        # a wedged daemon mustn't hang the health hook forever
+        s.settimeout(DAEMON_REPLY_TIMEOUT_SECONDS)
+        s.connect(socketPath)
+        s.sendall((hostAddress + "\n").encode("utf-8"))
+        with s.makefile("rb") as f:
+            reply = json.loads(f.readline().decode("utf-8"))
+    reply["latency"] = time.perf_counter() - start
+    return reply
+
+
+if __name__ == "__main__":
+    # script is called as 'python3 monClient.py host [socket]'
+    assert len(sys.argv) in (2, 3)
+    try:
+        reply = register(*sys.argv[1:])
+    except socket.timeout:
+        print("ERROR no reply from the daemon after {}s".format(
+            DAEMON_REPLY_TIMEOUT_SECONDS))
+        sys.exit(1)
+    if reply["ok"]:
+        print("Registered crash {} in {:.3f}s (daemon {:.3f}s){}".format(
+            reply["crash"], reply["latency"], reply["seconds"],
+            "" if reply.get("completed", True) else
+            ", already being registered"))
+    else:
+        print("ERROR registering crash after {:.3f}s: {}".format(
+            reply["latency"], reply["error"]))
+        sys.exit(1)
@@ -0,0 +1,62 @@
+'''Functions to find crashes that are similar to each other, according to the
+overlap (Jaccard similarity) of their users, queues, command clusters and
+host.
+
+Comparing a crash to every other crash is too slow so each crash gets a
+MinHash signature when it is registered: NUM_HASHES minimums of different
+hashes of its features. The chance that two signatures agree at a position is
+the Jaccard similarity of the two sets of features. The signature is split
+into bands and each band is hashed into a bucket (locality sensitive
+hashing), crashes that share a bucket in any band are the candidates for
+being similar. These buckets are saved in the database with an index so
+finding the candidates is one query (see models.CrashEvent.getSimilarCrashes).
+'''
+
+import hashlib
+import random
+from monitor.conf import SIMILAR_NUM_HASHES, SIMILAR_BANDS
+
+assert SIMILAR_NUM_HASHES % SIMILAR_BANDS == 0
+ROWS_PER_BAND = SIMILAR_NUM_HASHES // SIMILAR_BANDS
+
+# a prime larger than any hash of a feature
+PRIME = (1 << 61) - 1
+# the random hash functions h(x) = (a * x + b) % PRIME, the seed is fixed so
+# the signatures are the same in every process
+_rand = random.Random(20170101)
+HASH_PARAMETERS = [(_rand.randrange(1, PRIME), _rand.randrange(0, PRIME))
+                   for _ in range(SIMILAR_NUM_HASHES)]
+
+
+def stableHash(text, signed=False):
+    '''A 64 bit hash of a string that is the same in every process (unlike
+    hash()). signed so it fits in a database BigIntegerField.'''
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=signed)
+
+
+def minHash(features):
+    '''Returns the MinHash signature (a list of SIMILAR_NUM_HASHES ints) of a
+    set of strings, or None if there are no features'''
+    if not features:
+        return None
+    hashes = [stableHash(feature) % PRIME for feature in features]
+    return [min((a * x + b) % PRIME for x in hashes)
+            for a, b in HASH_PARAMETERS]
+
+
+def bandBuckets(signature):
+    'Returns a list of the (band, bucket) pairs of a signature'
+    return [(band, stableHash(",".join(str(value) for value in
+                                       signature[band * ROWS_PER_BAND:
+                                                 (band + 1) * ROWS_PER_BAND]),
+                              signed=True))
+            for band in range(SIMILAR_BANDS)]
+
+
+def jaccard(features1, features2):
+    'The size of the intersection over the size of the union of two sets'
+    union = len(features1 | features2)
+    if union == 0:
+        return 0
+    return len(features1 & features2) / union
@@ -0,0 +1,155 @@
+'''A content addressed store for the files saved for each crash (the lsf csv
+and the ganglia graphs).
+
+Files are saved under MEDIA_ROOT/blobs/<2 characters>/<sha256 of content> so
+identical content (eg the long period ganglia graphs of crashes on the same
+host a few minutes apart) is only stored once. Csv files are gzipped on disk
+and transparently decompressed when opened.
+
+Every stored file has a monitor.models.Blob which counts how many database
+fields reference it. Deleting a file (which happens when a CrashEvent or
+GangliaGraph is deleted) only drops a reference. Once the deletion commits,
+blobs with no references left are collected (the file and then the row
+removed). Saving and collecting both lock the blob's row first, so a blob
+with references always has its file:
+    - saving adds a reference (creating the row if needed) and then writes
+      the file if it is missing
+    - collecting checks there are still no references before removing the
+      file'''
+
+import gzip
+import hashlib
+import os
+import tempfile
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction, IntegrityError
+from django.db.models import F, Sum
+
+# the directory under MEDIA_ROOT that the blobs are saved in
+BLOB_DIR = "blobs/"
+# the extensions of files that are compressed before saving
+COMPRESS_EXTENSIONS = (".csv",)
+COMPRESSED_SUFFIX = ".gz"
+
+
+class BlobStorage(FileSystemStorage):
+    '''A django storage that saves files by the hash of their content. The
+    name passed in (from getUploadPath) is only used for its extension.'''
+
+    def get_available_name(self, name, max_length=None):
+        # the name is replaced in _save so there is never a clash
+        return name
+
+    def _save(self, name, content):
+        from monitor.models import Blob
+        # content may be a text file (eg the lsf csv) so encode if needed
+        data = b"".join(chunk.encode("utf-8") if isinstance(chunk, str)
+                        else chunk for chunk in content.chunks())
+        extension = os.path.splitext(name)[1]
+        compress = extension in COMPRESS_EXTENSIONS
+        digest = hashlib.sha256(data).hexdigest()
+        blobName = "{}{}/{}{}".format(BLOB_DIR, digest[:2], digest,
+                                      extension)
+        if compress:
+            blobName += COMPRESSED_SUFFIX
+            # mtime=0 so that the same content compresses to the same bytes
+            stored = gzip.compress(data, mtime=0)
+        else:
+            stored = data
+        with transaction.atomic():
+            # write before reading so the row is locked for the whole (short)
+            # transaction, then collectBlob can't remove the file until it
+            # sees this reference
+            try:
+                with transaction.atomic():
+                    Blob.objects.create(key=blobName, size=len(data),
+                                        storedSize=len(stored), references=1)
+            except IntegrityError:
+                # the same content has been saved before
+                self.addReference(blobName)
+            if not self.exists(blobName):
+                self.writeAtomically(blobName, stored)
+        return blobName
+
+    def addReference(self, name):
+        'Adds a reference to a blob, returning False if there is no blob'
+        from monitor.models import Blob
+        return Blob.objects.filter(key=name).update(
+            references=F("references") + 1) > 0
+
+    def writeAtomically(self, name, data):
+        '''Writes the file through a temporary file and a rename. Two crashes
+        saving the same content at the same time both write the same bytes to
+        the same name, rather than django renaming the second copy.'''
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temporaryPath = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # mkstemp only allows the owner to read, the web server needs to too
+        os.chmod(temporaryPath, self.file_permissions_mode or 0o644)
+        os.replace(temporaryPath, path)
+
+    def _open(self, name, mode="rb"):
+        if name.endswith(COMPRESSED_SUFFIX):
+            # always binary, decode after reading if text is needed
+            return File(gzip.open(self.path(name), "rb"), name)
+        return super()._open(name, mode)
+
+    def delete(self, name):
+        '''Drops one reference to the file. The file is removed from disk
+        once this commits if there are no references left.'''
+        if not name.startswith(BLOB_DIR):
+            # a file saved before the blob store (see migrateToBlobStore)
+            return super().delete(name)
+        from monitor.models import Blob
+        # the row is kept at 0 references (so a save of the same content
+        # updates it) until collectBlob removes it. If the transaction is
+        # rolled back the reference comes back and nothing is collected.
+        Blob.objects.filter(key=name).update(references=F("references") - 1)
+        transaction.on_commit(lambda: self.collectBlob(name))
+
+    def collectBlob(self, name):
+        '''Removes the file and the row of a blob that has no references,
+        returning True if it was removed'''
+        from monitor.models import Blob
+        with transaction.atomic():
+            # a write first so the row is locked before it is checked (the
+            # whole database on sqlite, where select_for_update does nothing).
+            # A save of the same content waits for this transaction.
+            Blob.objects.filter(key=name, references__lte=0).update(
+                references=0)
+            blob = Blob.objects.select_for_update().filter(key=name).first()
+            if blob is None or blob.references > 0:
+                # already collected or saved again since
+                return False
+            super().delete(name)
+            blob.delete()
+        return True
+
+
+def collectUnusedBlobs():
+    '''Collects every blob with no references (eg left when a process died
+    before collecting), returning the number removed'''
+    from monitor.models import Blob
+    unused = Blob.objects.filter(references__lte=0).values_list("key",
+                                                                flat=True)
+    return sum(blobStorage.collectBlob(key) for key in list(unused))
+
+
+def spaceReport():
+    '''Returns a dictionary of the number of bytes that would be stored
+    without the blob store ('logical'), the number actually stored and the
+    difference'''
+    from monitor.models import Blob
+    totals = Blob.objects.aggregate(
+        logical=Sum(F("size") * F("references")), stored=Sum("storedSize"))
+    logical = totals["logical"] or 0
+    stored = totals["stored"] or 0
+    return {"blobs": Blob.objects.count(), "logical": logical,
+            "stored": stored, "saved": logical - stored}
+
+
+blobStorage = BlobStorage()
@@ -1,3 +1,428 @@
-from django.test import TestCase
+import json
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from unittest import mock, skipIf
+from django.core.files.base import ContentFile
+from django.db import connection, transaction, IntegrityError
+from django.test import (TestCase, TransactionTestCase, RequestFactory,
+                         override_settings)
+from django.utils import timezone
+from monitor import mon, similarity, commandAnalyse, views
+from monitor.conf import (LSF_FIELDS, LSF_FIELDS_INDEX_USER,
+                          LSF_FIELDS_INDEX_QUEUE, LSF_FIELDS_INDEX_COMMAND,
+                          SIMILAR_NUM_HASHES, SIMILAR_BANDS)
+from monitor.models import (CrashEvent, Host, Blob, User, Queue, Command,
+                            addToSavedCommands, analyseCommandText,
+                            insertIgnoringConflict, getOrCreateByName,
+                            updateSignature)
+from monitor.storage import blobStorage
 
-# Create your tests here.
+
+def inMemoryDatabase():
+    '''True if the test database is an in memory sqlite database, where
+    threads can't wait for each other's locks'''
+    name = connection.settings_dict["TEST"].get("NAME") or ":memory:"
+    return connection.vendor == "sqlite" and (":memory:" in name or
+                                              "mode=memory" in name)
+
+
+def makeLsfRow(user, queue, command):
+    'A row of lsf data with only the fields that are used filled in'
+    row = [""] * len(LSF_FIELDS)
+    row[LSF_FIELDS_INDEX_USER] = user
+    row[LSF_FIELDS_INDEX_QUEUE] = queue
+    row[LSF_FIELDS_INDEX_COMMAND] = command
+    return row
+
+
+def useTemporaryMediaRoot(testCase):
+    'Saves the files of a test in a directory removed after the test'
+    mediaRoot = tempfile.mkdtemp(prefix="lotus-mon-test-")
+    mediaSettings = override_settings(MEDIA_ROOT=mediaRoot)
+    mediaSettings.enable()
+    testCase.addCleanup(mediaSettings.disable)
+    testCase.addCleanup(shutil.rmtree, mediaRoot, ignore_errors=True)
+
+
+def makeCrashWithLsfData(host, data):
+    'Saves a crash with lsf data'
+    crash = CrashEvent.objects.create(date=timezone.now(), host=host)
+    crash.setupLsfData(data, LSF_FIELDS)
+    crash.save()
+    return crash
+
+
+class BlobStorageTests(TransactionTestCase):
+    '''The reference counting of the blob store (monitor.storage). A
+    TransactionTestCase so that the files are removed on commit like they
+    are outside of tests.'''
+
+    def setUp(self):
+        useTemporaryMediaRoot(self)
+        self.host = Host.objects.create(address="host001.jc.rl.ac.uk")
+        self.data = [makeLsfRow("alice", "short-serial", "python run.py"),
+                     makeLsfRow("bob", "par-multi", "mpirun ./model")]
+        self.headers = LSF_FIELDS
+
+    def makeCrash(self, data=None):
+        'Saves a crash with lsf data (the same data by default)'
+        return makeCrashWithLsfData(self.host, data or self.data)
+
+    def testSharedContentIsStoredOnce(self):
+        first = self.makeCrash()
+        second = self.makeCrash()
+        self.assertEqual(first.lsfData.name, second.lsfData.name)
+        blob = Blob.objects.get(key=first.lsfData.name)
+        self.assertEqual(blob.references, 2)
+        self.assertTrue(blobStorage.exists(blob.key))
+        # different content gets its own blob
+        other = self.makeCrash([makeLsfRow("carol", "long", "sleep 100")])
+        self.assertNotEqual(other.lsfData.name, first.lsfData.name)
+        self.assertEqual(Blob.objects.count(), 2)
+
+    def testFileDeletedWithLastReference(self):
+        first = self.makeCrash()
+        second = self.makeCrash()
+        name = first.lsfData.name
+        first.delete()
+        self.assertEqual(Blob.objects.get(key=name).references, 1)
+        self.assertTrue(blobStorage.exists(name))
+        second.delete()
+        self.assertFalse(Blob.objects.filter(key=name).exists())
+        self.assertFalse(blobStorage.exists(name))
+
+    def testFileKeptWhenDeleteRolledBack(self):
+        crash = self.makeCrash()
+        name = crash.lsfData.name
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                crash.delete()
+                raise RuntimeError("roll back")
+        self.assertEqual(Blob.objects.get(key=name).references, 1)
+        self.assertTrue(blobStorage.exists(name))
+
+    def testCompressedCsvRoundTrip(self):
+        crash = self.makeCrash()
+        self.assertTrue(crash.lsfData.name.endswith(".csv.gz"))
+        # stored compressed on disk
+        with open(blobStorage.path(crash.lsfData.name), "rb") as f:
+            self.assertEqual(f.read(2), b"\x1f\x8b")
+        rows = CrashEvent.objects.get(pk=crash.pk).getLsfRows()
+        self.assertEqual(rows, [list(self.headers)] + self.data)
+
+    @skipIf(inMemoryDatabase(), "needs a database threads can share")
+    def testCollectWaitsForConcurrentSave(self):
+        # a blob with no references that hasn't been collected yet
+        name = blobStorage.save("graph.png", ContentFile(b"image"))
+        Blob.objects.filter(key=name).update(references=0)
+        saved = threading.Event()
+        commit = threading.Event()
+        results = {}
+
+        def save():
+            # saves the same content but doesn't commit until told to
+            try:
+                with transaction.atomic():
+                    results["name"] = blobStorage.save(
+                        "graph.png", ContentFile(b"image"))
+                    saved.set()
+                    commit.wait(10)
+            finally:
+                connection.close()
+
+        def collect():
+            try:
+                results["collected"] = blobStorage.collectBlob(name)
+            finally:
+                connection.close()
+
+        saver = threading.Thread(target=save)
+        saver.start()
+        self.assertTrue(saved.wait(10))
+        # the collector has to wait for the save's lock, give it time to
+        # try before the save commits
+        collector = threading.Thread(target=collect)
+        collector.start()
+        time.sleep(0.5)
+        commit.set()
+        saver.join()
+        collector.join()
+        self.assertEqual(results["name"], name)
+        self.assertFalse(results["collected"])
+        self.assertEqual(Blob.objects.get(key=name).references, 1)
+        self.assertTrue(blobStorage.exists(name))
+
+
+@mock.patch.object(mon, "queryGanglia")
+@mock.patch.object(mon, "queryLsf")
+@mock.patch.object(mon, "COALESCE_POLL_SECONDS", 0)
+@mock.patch.object(mon, "COALESCE_STALE_SECONDS", 60)
+@mock.patch.object(mon, "COALESCE_WINDOW_SECONDS", 30)
+class CoalescingTests(TransactionTestCase):
+    '''Registrations of a host that already has a recent or in-flight crash
+    (mon.runThroughCrash). lsf and ganglia aren't queried, a registration
+    that does query them shows up in their mocks.'''
+
+    def setUp(self):
+        self.address = "host002.jc.rl.ac.uk"
+        self.host = Host.objects.create(address=self.address)
+
+    def makeCrash(self, age, completed):
+        'Saves a crash that started age seconds ago'
+        date = timezone.now() - timedelta(seconds=age)
+        return CrashEvent.objects.create(
+            date=date, host=self.host, completedAt=date if completed else None)
+
+    def testRecentCompletedCrashReturned(self, queryLsf, queryGanglia):
+        recent = self.makeCrash(10, completed=True)
+        self.assertEqual(mon.runThroughCrash(self.address), recent)
+        queryLsf.assert_not_called()
+        self.assertEqual(CrashEvent.objects.count(), 1)
+
+    def testOldCompletedCrashNotReturned(self, queryLsf, queryGanglia):
+        old = self.makeCrash(40, completed=True)
+        crash = mon.runThroughCrash(self.address)
+        self.assertNotEqual(crash, old)
+        self.assertIsNotNone(crash.completedAt)
+        queryLsf.assert_called_once()
+
+    def testInFlightCrashReturnedStraightAway(self, queryLsf, queryGanglia):
+        inFlight = self.makeCrash(1, completed=False)
+        crash = mon.runThroughCrash(self.address)
+        self.assertEqual(crash, inFlight)
+        self.assertIsNone(crash.completedAt)
+        queryLsf.assert_not_called()
+
+    def testStaleCrashIgnored(self, queryLsf, queryGanglia):
+        stale = self.makeCrash(61, completed=False)
+        crash = mon.runThroughCrash(self.address)
+        self.assertNotEqual(crash, stale)
+        self.assertIsNotNone(crash.completedAt)
+        queryLsf.assert_called_once()
+        self.assertEqual(CrashEvent.objects.count(), 2)
+
+    def testWaitRunsOut(self, queryLsf, queryGanglia):
+        inFlight = self.makeCrash(1, completed=False)
+        crash = mon.runThroughCrash(self.address, waitSeconds=0.01)
+        self.assertEqual(crash, inFlight)
+        self.assertIsNone(crash.completedAt)
+        queryLsf.assert_not_called()
+
+    def testReregistersWhenWaitedOnCrashDeleted(self, queryLsf,
+                                                queryGanglia):
+        inFlight = self.makeCrash(1, completed=False)
+        # the other registration fails (deleting its crash) while waiting
+        fakeTime = mock.Mock(monotonic=time.monotonic,
+                             sleep=lambda seconds: inFlight.delete())
+        with mock.patch.object(mon, "time", fakeTime):
+            crash = mon.runThroughCrash(self.address, waitSeconds=5)
+        self.assertNotEqual(crash.pk, inFlight.pk)
+        self.assertIsNotNone(crash.completedAt)
+        queryLsf.assert_called_once()
+        self.assertEqual(CrashEvent.objects.count(), 1)
+
+
+class ConcurrentIngestionTests(TestCase):
+    '''The paths taken when another process registering a crash at the same
+    time makes the same change first (see models.addToSavedCommands)'''
+
+    def setUp(self):
+        self.host = Host.objects.create(address="host003.jc.rl.ac.uk")
+        self.crash = CrashEvent.objects.create(date=timezone.now(),
+                                               host=self.host)
+        self.user = User.objects.create(name="alice")
+
+    def testCommandCreatedDuringScanIsLinked(self):
+        text = "python run.py --input data.nc"
+        # another process saves the same command after the scan has looked
+        # at the table (so the scan finds nothing)
+        managerClass = type(Command.objects)
+
+        def racingIterator(manager, *args, **kwargs):
+            other = Command(text=text)
+            other.setDistribution(analyseCommandText(text))
+            other.save()
+            return iter([])
+        with mock.patch.object(managerClass, "iterator", racingIterator):
+            addToSavedCommands(text, self.user, self.crash)
+        command = Command.objects.get()
+        self.assertEqual(list(command.crashes.all()), [self.crash])
+        self.assertEqual(list(command.users.all()), [self.user])
+
+    def testInsertIgnoringConflict(self):
+        queue = Queue.objects.create(name="short-serial")
+        for _ in range(2):
+            insertIgnoringConflict(Queue.crashes.through, queue=queue,
+                                   crashevent=self.crash)
+        self.assertEqual(list(queue.crashes.all()), [self.crash])
+        # an integrity error that isn't a duplicate isn't hidden
+        with self.assertRaises(IntegrityError):
+            insertIgnoringConflict(Queue.crashes.through, queue=queue,
+                                   crashevent_id=None)
+
+    def testGetOrCreateByNameRetries(self):
+        managerClass = type(User.objects)
+        realGetOrCreate = managerClass.get_or_create
+        calls = []
+
+        def racingGetOrCreate(manager, **kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                # another process creates the user between the get and the
+                # create
+                manager.create(**kwargs)
+                raise IntegrityError("UNIQUE constraint failed")
+            return realGetOrCreate(manager, **kwargs)
+        with mock.patch.object(managerClass, "get_or_create",
+                               racingGetOrCreate):
+            user = getOrCreateByName(User, "bob")
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(user, User.objects.get(name="bob"))
+
+
+class SimilarityTests(TestCase):
+    'Finding similar crashes (similarity.py and getSimilarCrashes)'
+
+    def testMinHash(self):
+        features = {"h:1", "u:1", "u:2", "q:1"}
+        signature = similarity.minHash(features)
+        self.assertEqual(len(signature), SIMILAR_NUM_HASHES)
+        # the same however the set was built
+        self.assertEqual(signature, similarity.minHash(set(sorted(features))))
+        self.assertIsNone(similarity.minHash(set()))
+
+    def testBandBuckets(self):
+        features = {"h:1", "u:1", "u:2", "q:1"}
+        buckets = similarity.bandBuckets(similarity.minHash(features))
+        self.assertEqual(len(buckets), SIMILAR_BANDS)
+        self.assertEqual(buckets, similarity.bandBuckets(
+            similarity.minHash(set(features))))
+        disjoint = similarity.bandBuckets(similarity.minHash(
+            {"h:2", "u:3", "u:4", "q:2"}))
+        self.assertFalse(set(buckets) & set(disjoint))
+
+    def testJaccard(self):
+        self.assertEqual(similarity.jaccard({"a", "b"}, {"a", "b"}), 1)
+        self.assertEqual(similarity.jaccard({"a", "b"}, {"b", "c"}), 1 / 3)
+        self.assertEqual(similarity.jaccard({"a"}, {"b"}), 0)
+        self.assertEqual(similarity.jaccard(set(), set()), 0)
+
+    def makeCrash(self, host, users):
+        crash = CrashEvent.objects.create(date=timezone.now(), host=host)
+        for user in users:
+            user.crashes.add(crash)
+        updateSignature(crash)
+        return crash
+
+    def testGetSimilarCrashes(self):
+        host, otherHost = [Host.objects.create(
+            address="host{:03d}.jc.rl.ac.uk".format(i)) for i in (10, 11)]
+        users = [User.objects.create(name="user{}".format(i))
+                 for i in range(4)]
+        crash = self.makeCrash(host, users[:2])
+        same = self.makeCrash(host, users[:2])
+        # shares nothing with crash
+        self.makeCrash(otherHost, users[2:])
+        self.assertEqual(crash.getSimilarCrashes(5), [(1, same)])
+        self.assertEqual(same.getSimilarCrashes(5), [(1, crash)])
+
+
+class CorpusStatisticsTests(TestCase):
+    'The word statistics of the saved commands (see commandAnalyse)'
+
+    def testWordWeights(self):
+        weights = commandAnalyse.wordWeights(3, {"module": 3, "idl": 1})
+        self.assertEqual(weights["module"], 0)
+        self.assertAlmostEqual(weights["idl"], 0.5)
+        self.assertEqual(commandAnalyse.wordWeights(0, {}), {})
+
+    def testWeightDistribution(self):
+        distribution = {"module": 0.5, "idl": 0.5}
+        self.assertEqual(commandAnalyse.weightDistribution(
+            distribution, {"module": 0}), {"module": 0, "idl": 1})
+        # words without a weight count fully
+        self.assertEqual(commandAnalyse.weightDistribution(
+            distribution, {"module": 0.5}), {"module": 1 / 3, "idl": 2 / 3})
+        # not changed if every word would count for nothing
+        self.assertEqual(commandAnalyse.weightDistribution(
+            distribution, {"module": 0, "idl": 0}), distribution)
+
+    def testCorpusStatistics(self):
+        useTemporaryMediaRoot(self)
+        host = Host.objects.create(address="host004.jc.rl.ac.uk")
+        first = [makeLsfRow("alice", "short-serial",
+                            "module load idl;idl run.pro"),
+                 makeLsfRow("bob", "short-serial",
+                            "module load cdo;cdo mergetime a.nc b.nc")]
+        second = [makeLsfRow("carol", "par-multi", "python run.py")]
+        makeCrashWithLsfData(host, first)
+        # an identical snapshot is stored once so it is only counted once
+        makeCrashWithLsfData(host, first)
+        makeCrashWithLsfData(host, second)
+        numCommands, documentFrequency, proportions = \
+            commandAnalyse.corpusStatistics(processes=2)
+        # the same as analysing the commands one by one
+        distributions = [commandAnalyse.analyseCommand(row[
+            LSF_FIELDS_INDEX_COMMAND]) for row in first + second]
+        self.assertEqual(numCommands, 3)
+        self.assertEqual(documentFrequency,
+                         Counter(word for distribution in distributions
+                                 for word in distribution))
+        self.assertEqual(documentFrequency["module"], 2)
+        self.assertEqual(set(proportions), set(documentFrequency))
+        self.assertAlmostEqual(sum(proportions.values()), 3)
+
+
+@mock.patch.object(views, "FEED_POLL_SECONDS", 0.01)
+@mock.patch.object(views, "FEED_DURATION_SECONDS", 0.2)
+class CrashFeedTests(TestCase):
+    'The live feed of crashes (views.crashFeed), with short streams'
+
+    def setUp(self):
+        self.host = Host.objects.create(address="host005.jc.rl.ac.uk")
+        self.since = timezone.now() - timedelta(minutes=5)
+
+    def makeCrash(self, completedAt):
+        return CrashEvent.objects.create(date=completedAt, host=self.host,
+                                         completedAt=completedAt)
+
+    def crashIds(self, events):
+        'The ids of the crashes sent by a list of events'
+        return [json.loads(event.split("data: ")[1])["id"]
+                for event in events if "event: crash" in event]
+
+    def testStartsWithId(self):
+        events = list(views.crashFeedEvents(self.since))
+        self.assertIn("\nid: {}\n".format(self.since.isoformat()),
+                      events[0])
+        self.assertEqual(self.crashIds(events), [])
+
+    def testLateCrashSentOnceEach(self):
+        first = self.makeCrash(self.since + timedelta(seconds=10))
+        events = views.crashFeedEvents(self.since)
+        sent = [next(events), next(events)]
+        self.assertEqual(self.crashIds(sent), [first.pk])
+        # committed after first was sent but completed before it
+        late = self.makeCrash(self.since + timedelta(seconds=5))
+        sent.extend(events)
+        # re-reading the overlap sends late but not first again
+        self.assertEqual(self.crashIds(sent), [first.pk, late.pk])
+
+    def testInvalidLastEventIdFallsBackToSince(self):
+        old = self.makeCrash(self.since - timedelta(minutes=5))
+        new = self.makeCrash(self.since + timedelta(seconds=10))
+        request = RequestFactory().get(
+            "/crash-feed", {"since": self.since.isoformat()},
+            HTTP_LAST_EVENT_ID="2026-13-45T00:00")
+        response = views.crashFeed(request)
+        self.assertEqual(response.status_code, 200)
+        events = [chunk.decode("utf-8")
+                  for chunk in response.streaming_content]
+        self.assertIn("\nid: {}\n".format(self.since.isoformat()),
+                      events[0])
+        self.assertEqual(self.crashIds(events), [new.pk])
+        self.assertNotIn(old.pk, self.crashIds(events))
@@ -6,9 +6,12 @@ from django.conf import settings
 app_name = 'monitor'
 urlpatterns = [
     url(r'^$', views.index, name="index"),
+    url(r'^crash-feed$', views.crashFeed, name="crashFeed"),
     url(r'^register-crash/(?P<host>host[0-9]{3}\.jc\.rl\.ac\.uk)$',
         views.registerCrash, name="registerCrash"),
     url(r'^saved-crash/(?P<i>[0-9]+$)', views.detailOfCrash,
-        name="savedCrash")
+        name="savedCrash"),
+    url(r'^saved-crash/(?P<i>[0-9]+)/lsf\.csv$', views.lsfCsv,
+        name="lsfCsv")
 ] + (static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) +
      static(settings.STATIC_URL, document_root=settings.STATIC_ROOT))
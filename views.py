@@ -1,8 +1,17 @@
 from django.shortcuts import render, get_object_or_404
+from django.http import HttpResponse, Http404, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone, formats
+from django.utils.dateparse import parse_datetime
 from monitor.mon import runThroughCrash
+from monitor.conf import (FEED_POLL_SECONDS, FEED_KEEPALIVE_SECONDS,
+                          FEED_DURATION_SECONDS, FEED_OVERLAP_SECONDS,
+                          SIMILAR_TOP_K)
 from .models import CrashEvent, User, Host, Command, Queue
-from django.db.models import Count
-import csv  # for parsing lsf data
+from django.db.models import Count, Max
+from datetime import timedelta
+import json
+import time
 # Create your views here.
 
 
@@ -21,6 +30,10 @@ def index(request):
     page which this page extends'''
     context = baseContext()
     context['crashesByDate'] = CrashEvent.objects.order_by('-date')
+    # the live feed sends the crashes completed after the page was made
+    feedSince = (CrashEvent.objects.aggregate(Max("completedAt"))
+                 ["completedAt__max"] or timezone.now())
+    context['feedSince'] = feedSince.isoformat()
     # order the rest of the data by counting the associated crashes using
     # the C annotation and then ordering in reverse and removing the 0s
     hostData = [(host.crashevent_set.order_by("-date"), host.address, False)
@@ -64,23 +77,111 @@ def detailOfCrash(request, i=False):
     crash = get_object_or_404(CrashEvent, id=i)
     context = baseContext()
     context["crash"] = crash
-    context["ganglias"] = crash.gangliagraph_set.all()
-    # This try, except is required to force the file not to open in binary mode
-    try:
-        # change from the default of 'rb'
-        crash.lsfData.read()
-        crash.lsfData.close()
-        crash.lsfData.open(mode="r")
-        crash.lsfData.seek(0)
-    except ValueError as e:
-        # if there is a value error then there is no lsf data for this class
+    context["ganglias"] = list(crash.gangliagraph_set.all())
+    if not context["ganglias"]:
+        # the template only shows that the crash isn't available
+        return render(request, "monitor/detailOfCrash.html", context)
+    context["similarCrashes"] = crash.getSimilarCrashes(SIMILAR_TOP_K)
+    rows = crash.getLsfRows()
+    if rows is None:
+        # there is no lsf data for this crash
         context["noLsfData"] = True
     else:
         context["noLsfData"] = False
-        # get csv to parse the rows
-        rows = [[element for element in row]
-                for row in csv.reader(crash.lsfData)]
-        crash.lsfData.close()
         context["lsfHeaders"] = rows[0]
         context["lsfRows"] = rows[1:]
     return render(request, "monitor/detailOfCrash.html", context)
+
+
+def lsfCsv(request, i=False):
+    '''Returns the lsf csv of a crash. The file may be compressed on disk so
+    it is served from here rather than directly from the media url'''
+    assert i is not False
+    crash = get_object_or_404(CrashEvent, id=i)
+    if not crash.lsfData:
+        raise Http404("No lsf data for this crash")
+    with crash.lsfData.storage.open(crash.lsfData.name, "rb") as f:
+        response = HttpResponse(f.read(), content_type="text/csv")
+    response["Content-Disposition"] = 'inline; filename="{}"'.format(
+        CrashEvent.LSF_NAME)
+    return response
+
+
+def crashSummary(event):
+    '''The data about a crash that is sent by the live feed, the same as
+    baseContext gives the templates'''
+    return {
+        "id": event.id,
+        "host": event.host.address,
+        # formatted as the templates would
+        "date": formats.date_format(timezone.localtime(event.date),
+                                    "DATETIME_FORMAT"),
+        "url": reverse("monitor:savedCrash", args=[event.id]),
+    }
+
+
+def crashFeedEvents(since):
+    '''A generator of Server-Sent Events for each crash completed after
+    since (a datetime). The id of the events is the completed time of the
+    newest crash sent so the browser can resume from it when it reconnects.
+
+    Crashes that completed up to FEED_OVERLAP_SECONDS before that are sent
+    again after reconnecting (the page skips crashes it already shows), so a
+    crash that was committed late isn't missed.'''
+    overlap = timedelta(seconds=FEED_OVERLAP_SECONDS)
+    # tell the browser how long to wait before reconnecting (milliseconds)
+    # and where to resume from, even if no crashes are sent on this stream
+    yield "retry: {}\nid: {}\n\n".format(FEED_POLL_SECONDS * 1000,
+                                          since.isoformat())
+    sent = {}  # the completed time of crashes sent that may be read again
+    start = lastSent = time.monotonic()
+    while time.monotonic() - start < FEED_DURATION_SECONDS:
+        # one query on an index, however many crashes there are
+        crashes = (CrashEvent.objects
+                   .filter(completedAt__gt=since - overlap)
+                   .exclude(pk__in=list(sent))
+                   .select_related("host").order_by("completedAt"))
+        for crash in crashes:
+            since = max(since, crash.completedAt)
+            sent[crash.pk] = crash.completedAt
+            lastSent = time.monotonic()
+            yield "id: {}\nevent: crash\ndata: {}\n\n".format(
+                since.isoformat(), json.dumps(crashSummary(crash)))
+        # forget the crashes that are too old to be read again
+        sent = dict((pk, completedAt) for pk, completedAt in sent.items()
+                    if completedAt > since - overlap)
+        if time.monotonic() - lastSent > FEED_KEEPALIVE_SECONDS:
+            # a comment, so a closed connection is noticed
+            lastSent = time.monotonic()
+            yield ": keepalive\n\n"
+        time.sleep(FEED_POLL_SECONDS)
+
+
+def parseFeedTime(value):
+    '''Parses a time sent back to the feed (an event id or the since
+    parameter), returning None if it is missing or not a valid time'''
+    try:
+        parsed = parse_datetime(value or "")
+    except ValueError:
+        # well formatted but impossible, eg month 13
+        return None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def crashFeed(request):
+    '''Streams crashes to the index page as they are registered so it doesn't
+    have to be reloaded. Each viewer holds one web server worker while
+    connected so the stream ends after FEED_DURATION_SECONDS and the browser
+    reconnects.'''
+    # sent by the browser when reconnecting, the id of the last event,
+    # otherwise the page says when its newest crash completed
+    since = (parseFeedTime(request.META.get("HTTP_LAST_EVENT_ID")) or
+             parseFeedTime(request.GET.get("since")) or timezone.now())
+    response = StreamingHttpResponse(crashFeedEvents(since),
+                                     content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # stop proxies from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response